@@ -1,13 +1,24 @@
 #! /usr/local/bin/python3
 
 import argparse
-from collections import namedtuple
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, OrderedDict
+import hashlib
+from itertools import accumulate, chain, compress, filterfalse, islice, repeat
+import locale
+import mmap
 import os
 import re
-from subprocess import Popen, PIPE
+import shutil
+from subprocess import Popen, PIPE, TimeoutExpired
 import sys
 from syslog import openlog, syslog, LOG_PID, LOG_PERROR, LOG_LOCAL7, LOG_DEBUG, LOG_ERR
 import tempfile
+import threading
+import time
+import wcache
+import wstats
 
 
 Changed =   namedtuple("Changed",   ["diff_command", "a_start", "a_end", "a_lines", "b_start", "b_end", "b_lines"])
@@ -15,90 +26,987 @@ Added =     namedtuple("Added",     ["diff_command", "a_start", "a_end", "a_line
 Deleted =   namedtuple("Deleted",   ["diff_command", "a_start", "a_end", "a_lines", "b_start", "b_end", "b_lines"])
 Unchanged = namedtuple("Unchanged", ["diff_command", "a_start", "a_end", "a_lines", "b_start", "b_end", "b_lines"])
 
-Sensible =  namedtuple("Sensible",  ["raw_index", "token", "start", "end"])
 Token =     namedtuple("Token",     ["token", "start", "end"])
 
+## token level diff backend used by changed().
+##   "myers" : in-process diff over interned token ids (diff_sequences)
+##   "diff"  : external `diff -n` through tempfiles (reference backend)
+TOKEN_DIFF_BACKENDS = ("myers", "diff")
+TOKEN_DIFF = os.environ.get("NDIFF_TOKEN_DIFF", "myers")
+
+## line level diff backend used by diff_n().
+##   "auto"  : "myers" when the lines left after common_ends() are fewer
+##             than LINE_DIFF_MAX (a and b together), "diff" otherwise
+##   "myers" : in-process diff over interned line ids (diff_lines), which
+##             saves the fork but is slower than diff on long middles
+##   "diff"  : external `diff -n` (reference backend)
+LINE_DIFF_BACKENDS = ("auto", "myers", "diff")
+LINE_DIFF = os.environ.get("NDIFF_LINE_DIFF", "auto")
+LINE_DIFF_MAX = int(os.environ.get("NDIFF_LINE_DIFF_MAX", 2048))
+
+## files of this size or larger are memory-mapped instead of read (mapfile)
+LARGE_FILE = int(os.environ.get("NDIFF_LARGE_FILE", 32 << 20))
+
+## Changed hunks are independent, so changed() of each can run on a pool of
+## JOBS workers (1 runs them all inline).  hunks smaller than PARALLEL_MIN
+## bytes (a and b together) stay inline, as do files with fewer than two
+## large hunks.
+##   "process" : multiprocessing.Pool, for the in-process token diff
+##   "thread"  : a thread pool, enough for the "diff" token backend
+JOBS = int(os.environ.get("NDIFF_JOBS", 1))
+PARALLEL_MIN = int(os.environ.get("NDIFF_PARALLEL_MIN", 256 << 10))
+POOL_KINDS = ("process", "thread")
+POOL = os.environ.get("NDIFF_POOL", "process")
+
+## how much of the changelists is checked against the lines they came from.
+##   "full"    : every unchanged line and token (for tests and fuzzing)
+##   "sampled" : one in VERIFY_SAMPLE of those checks, and the cheap ones
+##   "off"     : only the checks that do not look at the lines
+VERIFY_LEVELS = ("off", "sampled", "full")
+VERIFY = os.environ.get("NDIFF_VERIFY", "sampled")
+VERIFY_SAMPLE = int(os.environ.get("NDIFF_VERIFY_SAMPLE", 16))
+verify_count = 0
+
+## Changed hunks of at least ANCHOR_MIN tokens (a and b together) are first
+## split on tokens that occur once on each side (patience diff), and the
+## pieces are token-diffed apart.  0 diffs every hunk whole.
+ANCHOR_MIN = int(os.environ.get("NDIFF_ANCHOR_MIN", 2048))
+
+## the same hunk comes up again and again in a `git log -p` walk (license
+## headers, tree-wide renames), so changed() results are memoized by the
+## hashes of the hunk: up to MEMO_SIZE bytes in memory (0 disables), least
+## recently used out first, and with NDIFF_MEMO_DISK=1 in the wcache
+## directory too, so that they carry over between processes.
+MEMO_SIZE = int(os.environ.get("NDIFF_MEMO_SIZE", 16 << 20))
+MEMO_DISK = os.environ.get("NDIFF_MEMO_DISK", "") not in ("", "0")
+memo = OrderedDict()        ## key -> the midway text of the hunk
+memo_lock = threading.Lock()
+memo_counts = {"hits": 0, "disk_hits": 0, "misses": 0, "bytes": 0}
+
+## budgets of the token diffs (0 for none): tokens and seconds per Changed
+## hunk, and per file.  a hunk over budget is shown line by line, as plain
+## diff shows it, instead of token by token (see Budget).
+HUNK_TOKENS = int(os.environ.get("NDIFF_HUNK_TOKENS", 0))
+HUNK_SECONDS = float(os.environ.get("NDIFF_HUNK_SECONDS", 0))
+FILE_TOKENS = int(os.environ.get("NDIFF_FILE_TOKENS", 0))
+FILE_SECONDS = float(os.environ.get("NDIFF_FILE_SECONDS", 0))
+
+## the sensible tokens of the two files are compared first, TOKEN_BLOCK bytes
+## of each at a time; when they are all equal the change is white space
+## only, and the midway text is b, with no line or token diff to run.
+WHITESPACE_CHECK = os.environ.get("NDIFF_WHITESPACE_CHECK", "1") not in ("", "0")
+TOKEN_BLOCK = int(os.environ.get("NDIFF_TOKEN_BLOCK", 64 << 10))
+
+## chunks of midway text handed to each writelines() of the output file
+WRITE_BATCH = int(os.environ.get("NDIFF_WRITE_BATCH", 1024))
+
 
 def main():
     openlog(os.path.basename(__file__), LOG_PID | LOG_PERROR, LOG_LOCAL7)
-    #syslog(LOG_DEBUG, f"argv={sys.argv}")
 
     parser = argparse.ArgumentParser()
     parser.add_argument("file_a")
     parser.add_argument("file_b")
     parser.add_argument("file_out")
+    parser.add_argument("--token-diff", choices=TOKEN_DIFF_BACKENDS, default=TOKEN_DIFF)
+    parser.add_argument("--line-diff", choices=LINE_DIFF_BACKENDS, default=LINE_DIFF)
+    parser.add_argument("-j", "--jobs", type=int, default=JOBS)
+    parser.add_argument("--verify", choices=VERIFY_LEVELS, default=VERIFY)
+    parser.add_argument("--patch", help="unified diff of file_a and file_b (git diff -U0) to use instead of diff -n")
     args = parser.parse_args()
-    ndiff(args.file_a, args.file_b, args.file_out)
+    wstats.start("ndiff")
+    try:
+        tokenizer = tokenizer_for(args.file_a) or c_tokenizer
+        patch = None
+        if args.patch:
+            with open(args.patch, "rb") as f:
+                patch = f.read()
+        ndiff(args.file_a, args.file_b, args.file_out, token_diff=args.token_diff, jobs=args.jobs, verify=args.verify, tokenizer=tokenizer, patch=patch, line_diff=args.line_diff)
+    finally:
+        wstats.finish()
 
 
-def ndiff(file_a, file_b, file_out):
-    (r, lines_a, lines_b, raw_a, raw_b) = diff_n(file_a, file_b)
-    if r is None:
-        with open(file_out, mode="wb") as f:
-            f.write(b"Binary files " + file_a.encode() + b" and " + file_b.encode() + b" differ\n")
+"""
+writes the midway file of file_a and file_b to file_out as the changelist
+is walked, so the output starts with the first hunk and the midway text is
+never held whole.  identical files are copied, and so is b when the
+change is white space only.  patch and line_diff are as for diff_n().
+"""
+def ndiff(file_a, file_b, file_out, token_diff=None, jobs=None, verify=None, tokenizer=None, budget=None, patch=None, line_diff=None):
+    check = precheck(file_a, file_b)
+    if check == "same" or check is None and whitespace_only(file_a, file_b, tokenizer):
+        with open(file_a if check == "same" else file_b, "rb") as f_in, open(file_out, mode="wb") as f:
+            shutil.copyfileobj(f_in, f)
         return
-    a_mid = changelist_to_midway(r, lines_a, lines_b)
+    (r, lines_a, lines_b, raw_a, raw_b) = diff_n(file_a, file_b, verify=verify, check=check, patch=patch, line_diff=line_diff)
     with open(file_out, mode="wb") as f:
-        write_tokens_to_file(f, a_mid)
+        if r is None:
+            f.write(b"Binary files " + file_a.encode() + b" and " + file_b.encode() + b" differ\n")
+            return
+        write_chunks(f, midway_chunks(r, lines_a, lines_b, token_diff=token_diff, jobs=jobs, verify=verify, tokenizer=tokenizer, budget=budget))
+
+
+"""
+ndiff of two buffers (bytes, bytearray, memoryview or mmap) with no
+filesystem I/O: the lines are diffed in-process by diff_sequences(), which
+aligns them as `diff -n` does, instead of by running diff on files.
+returns None when the buffers differ and are binary, else (midway, unified):
+the midway text as a list of chunks (write them with writelines() or join
+them), and with `context`, the unified diff from the midway text to b as
+ndiff_unified() returns it (None without).
+"""
+def ndiff_bytes(a, b, context=None, token_diff=None, jobs=None, verify=None, tokenizer=None, budget=None, patch=None):
+    if WHITESPACE_CHECK and not is_binary(a, b) and same_tokens(a, b, tokenizer):
+        wstats.count("whitespace_files")
+        return ([b] if len(b) > 0 else [], None if context is None else [])
+    return ndiff_changes(diff_buffers(a, b, patch=patch), context=context, token_diff=token_diff, jobs=jobs, verify=verify, tokenizer=tokenizer, budget=budget)
 
 
-def changelist_to_midway(r, lines_a, lines_b):
-    a_mid = []
+"""
+what ndiff_bytes() returns, from what diff_n() or diff_buffers() returns.
+"""
+def ndiff_changes(d, context=None, token_diff=None, jobs=None, verify=None, tokenizer=None, budget=None):
+    (r, lines_a, lines_b, raw_a, raw_b) = d
+    if r is None:
+        return None
+    if context is None:
+        return (changelist_to_midway(r, lines_a, lines_b, token_diff=token_diff, jobs=jobs, verify=verify, tokenizer=tokenizer, budget=budget), None)
+    (chunks, mid, b, changes) = midway_changes(r, lines_a, lines_b, token_diff=token_diff, jobs=jobs, verify=verify, tokenizer=tokenizer, budget=budget)
+    with wstats.timer("unified"):
+        return (chunks, changes_to_hunks(mid, b, changes, context))
+
+
+def changelist_to_midway(r, lines_a, lines_b, token_diff=None, jobs=None, verify=None, tokenizer=None, budget=None):
+    return list(midway_chunks(r, lines_a, lines_b, token_diff=token_diff, jobs=jobs, verify=verify, tokenizer=tokenizer, budget=budget))
+
+
+"""
+the midway text as a generator of chunks, entry by entry of the changelist.
+"""
+def midway_chunks(r, lines_a, lines_b, token_diff=None, jobs=None, verify=None, tokenizer=None, budget=None):
+    hunks = changed_hunks(r, token_diff=token_diff, jobs=jobs, verify=verify, tokenizer=tokenizer, budget=budget)
     for e in r:
         (diff_command, a_start, a_end, a_lines, b_start, b_end, b_lines) = e
         if e.__class__ == Changed:
-            #syslog(LOG_DEBUG, f"@@@ CHANGED {e}")
-            (a_midway, b_midway) = changed(e)
-            a_mid += a_midway
+            (a_midway, b_midway) = next(hunks)
+            yield from a_midway
         elif e.__class__ == Added:
-            #syslog(LOG_DEBUG, f"@@@ ADDED {e}")
+            if blank_entry(e, tokenizer):
+                yield from line_chunks(b_lines)
+        elif e.__class__ == Deleted and blank_entry(e, tokenizer):
             pass
-        elif e.__class__ == Unchanged:
-            #syslog(LOG_DEBUG, f"@@@ UNCHANGED {e}")
+        elif e.__class__ == Unchanged or e.__class__ == Deleted:
             a_midway = a_lines if a_start > 0 else a_lines[1:]
             if a_end == len(lines_a):
                 a_midway = a_midway[:-1]
-            a_mid += a_midway
+            yield from line_chunks(a_midway)
+        else:
+            raise Exception("Internal Error")
+
+
+def line_chunks(lines):
+    if lines.__class__ == LineView:
+        return [lines.body()]   ## one zero-copy chunk instead of a bytes per line
+    return lines
+
+
+"""
+whether e is an Added or Deleted entry of lines of white space only, which
+the midway text takes from b as changed hunks of white space only, when
+WHITESPACE_CHECK is on.
+"""
+def blank_entry(e, tokenizer=None):
+    if not WHITESPACE_CHECK or e.__class__ not in (Added, Deleted):
+        return False
+    lines = e.b_lines if e.__class__ == Added else e.a_lines
+    if bytes(b"".join(line_chunks(lines))).translate(None, space_bytes(tokenizer)):
+        return False
+    wstats.count("whitespace_hunks")
+    return True
+
+
+"""
+the unified diff from the midway file to file_b, as `diff -up` prints it
+but without the ---/+++ header lines.  computed from the changelist, so the
+midway file is never written nor diffed again: unchanged, deleted and added
+entries map to lines directly, and only the lines of Changed entries are
+diffed against file_b.
+"""
+def ndiff_unified(file_a, file_b, context=3, token_diff=None, jobs=None, verify=None, tokenizer=None, budget=None, patch=None, line_diff=None):
+    check = precheck(file_a, file_b)
+    if check == "same" or check is None and whitespace_only(file_a, file_b, tokenizer):
+        return []
+    result = ndiff_changes(diff_n(file_a, file_b, verify=verify, check=check, patch=patch, line_diff=line_diff), context=context, token_diff=token_diff, jobs=jobs, verify=verify, tokenizer=tokenizer, budget=budget)
+    if result is None:
+        return []       ## binary
+    return result[1]
+
+
+"""
+a unified diff of two buffers in the format of `diff -up`, in-process,
+without the ---/+++ header lines.  [] when they differ and are binary, as
+diff prints nothing else then.  the lines are aligned as `diff -n` aligns
+them; `diff -U` may align some differently, as the context lines take part
+in its choice, so the hunks are not always the same as diff's.
+"""
+def unified_bytes(a, b, context=3):
+    if is_binary(a, b):
+        return []
+    (lines_a, lines_b) = (buffer_lines(a), buffer_lines(b))
+    ids = {}
+    (changed_a, changed_b) = compare_sequences([ids.setdefault(x, len(ids)) for x in lines_a[1:-1]], [ids.setdefault(x, len(ids)) for x in lines_b[1:-1]])
+    return unified_hunks(lines_a[1:-1], lines_b[1:-1], changed_a, changed_b, context)
+
+
+"""
+ndiff_bytes() of one base a against version after version of b, for
+editors and file watchers that re-diff a file on every save.  the session
+keeps the lines of a and their ids, the changelist and the midway text of
+each of its entries; update() diffs only the lines from the first to the
+last line b changed in (see common_ends()), widened to the entries they
+touch, token diffs the Changed entries among them, and keeps the rest.
+the pieces are compared on their own, so the alignment may differ from a
+diff of the whole files where a change could slide past them.
+"""
+class Session:
+    def __init__(self, a, token_diff=None, jobs=None, verify=None, tokenizer=None):
+        a = a if a.__class__ == mmap.mmap else bytes(a)
+        self.raw_a = a
+        self.lines_a = LineView(a, line_offsets(a))
+        self.ids = {}
+        self.a_ids = [self.ids.setdefault(e, len(self.ids)) for e in self.lines_a[1:-1]]
+        self.options = {"token_diff": token_diff, "jobs": jobs, "verify": verify, "tokenizer": tokenizer}
+        self.raw_b = None
+        self.lines_b = None
+        self.r = None           ## the changelist, None when b is binary or not yet given
+        self.midway = None      ## [chunks] of each entry of r
+
+    """
+    the midway text of a and b, as a list of chunks, or None when they
+    differ and are binary.  b is any buffer ndiff_bytes() takes, and as
+    there, a change of white space only gives b.  the changelist is kept
+    up to date all the same, for the next b.
+    """
+    def update(self, b, budget=None):
+        b = b if b.__class__ == mmap.mmap else bytes(b)
+        chunks = self.rediff(b, budget)
+        if chunks is not None and WHITESPACE_CHECK and same_tokens(self.raw_a, b, self.options["tokenizer"]):
+            wstats.count("whitespace_files")
+            return [b] if len(b) > 0 else []
+        return chunks
+
+    def rediff(self, b, budget=None):
+        if is_binary(self.raw_a, b):
+            (self.raw_b, self.lines_b, self.r, self.midway) = (b, None, None, None)
+            return None
+        if self.r is None:
+            lines_b = LineView(b, line_offsets(b))
+            with wstats.timer("line_diff"):
+                (c_a, c_b) = compare_sequences(self.a_ids, self.b_ids(lines_b[1:-1]))
+            r = changed_to_changelist(c_a, c_b, self.lines_a, lines_b)
+            (self.raw_b, self.lines_b, self.r, self.midway) = (b, lines_b, r, self.entry_midway(r, budget))
+            return self.chunks()
+
+        ends = common_ends(self.raw_b, self.lines_b, b, None)
+        (head, tail) = ends[:2]
+        lines_b = LineView(b, self.spliced_offsets(b, ends))
+        (lo, hi) = (head + 1, len(self.lines_b) - 1 - tail)        ## lines of the old b that changed
+        delta = len(lines_b) - len(self.lines_b)
+        if lo == hi and delta == 0:
+            (self.raw_b, self.lines_b) = (b, lines_b)
+            return self.chunks()
+        wstats.count("session_updates")
+
+        ## the window: [lo, hi) widened to the entries it touches, then cut
+        ## in the Unchanged entries it ends in.  p and q are the Unchanged
+        ## entries before and after the window, whose lines next to it are
+        ## diffed too, as sentinels.
+        r = self.r
+        i_lo = bisect_left([e.b_end for e in r], lo)
+        i_hi = bisect_right([e.b_start for e in r], hi) - 1
+        if r[i_hi].__class__ == Unchanged and hi == r[i_hi].b_end:
+            i_hi += 1
+        p = i_lo if r[i_lo].__class__ == Unchanged else i_lo - 1
+        q = i_hi if r[i_hi].__class__ == Unchanged else i_hi + 1
+        (wa, wb) = (r[i_lo].a_start + lo - r[i_lo].b_start, lo) if p == i_lo else (r[i_lo].a_start, r[i_lo].b_start)
+        (wa_end, wb_end) = (r[i_hi].a_start + hi - r[i_hi].b_start, hi) if q == i_hi else (r[i_hi].a_end, r[i_hi].b_end)
+        wstats.count("session_lines", wa_end - wa + wb_end + delta - wb)
+
+        with wstats.timer("line_diff"):
+            (c_a, c_b) = compare_sequences(self.a_ids[wa - 1:wa_end - 1], self.b_ids(lines_b[wb:wb_end + delta]))
+        window = changed_to_changelist(c_a, c_b, self.lines_a, lines_b, wa - 1, wb - 1)
+
+        ## the sentinels of the window join the Unchanged entries around it
+        (a_start, b_start) = (r[p].a_start, r[p].b_start)
+        (a_end, b_end) = (r[q].a_end, r[q].b_end + delta)
+        if len(window) == 1:
+            ends = [self.unchanged(a_start, a_end, b_start, b_end, lines_b)]
+        else:
+            ends = [self.unchanged(a_start, window[0].a_end, b_start, window[0].b_end, lines_b),
+                    self.unchanged(window[-1].a_start, a_end, window[-1].b_start, b_end, lines_b)]
+        middle = ends[:1] + window[1:-1] + ends[1:]
+        after = r[q + 1:] if delta == 0 else [e._replace(b_start=e.b_start + delta, b_end=e.b_end + delta, b_lines=lines_b[e.b_start + delta:e.b_end + delta] if e.b_lines else e.b_lines) for e in r[q + 1:]]
+        self.r = r[:p] + middle + after
+        self.midway = self.midway[:p] + self.entry_midway(middle, budget) + self.midway[q + 1:]
+        (self.raw_b, self.lines_b) = (b, lines_b)
+        if verifying(self.options["verify"]):
+            assert [(e.a_end, e.b_end) for e in self.r[:-1]] == [(e.a_start, e.b_start) for e in self.r[1:]]
+            assert self.r[-1].a_end == len(self.lines_a) and self.r[-1].b_end == len(lines_b)
+        return self.chunks()
+
+    """
+    update() with the bytes [start, end) of the current b replaced by data.
+    """
+    def edit(self, start, end, data, budget=None):
+        b = memoryview(self.raw_b)
+        return self.update(b"".join((b[:start], data, b[end:])), budget=budget)
+
+    """
+    the line offsets of b, from those of the current b: only the lines
+    between the common ends are split, and the tail is shifted.
+    """
+    def spliced_offsets(self, b, ends):
+        (head, tail, head_bytes, tail_bytes) = ends
+        old = self.lines_b.offsets
+        offsets = array("Q", old[:head + 1])
+        offsets.extend(map(head_bytes.__add__, line_offsets(bytes(b[head_bytes:len(b) - tail_bytes]))[1:]))
+        offsets.extend(map((len(b) - len(self.raw_b)).__add__, old[len(old) - tail:]))
+        return offsets
+
+    def chunks(self):
+        return None if self.midway is None else [c for m in self.midway for c in m]
+
+    """
+    ids of lines of b: the ids of the lines of a, and for other lines ids
+    below 0 that are not kept, so that the table only holds a.
+    """
+    def b_ids(self, lines):
+        (ids, other) = (self.ids, {})
+        return [ids[e] if e in ids else other.setdefault(e, -1 - len(other)) for e in lines]
+
+    def unchanged(self, a_start, a_end, b_start, b_end, lines_b):
+        return Unchanged(None, a_start, a_end, self.lines_a[a_start:a_end], b_start, b_end, lines_b[b_start:b_end])
+
+    def entry_midway(self, r, budget=None):
+        hunks = changed_hunks(r, budget=budget, **self.options)
+        return [list(next(hunks)[0]) if e.__class__ == Changed else list(midway_chunks([e], self.lines_a, None, tokenizer=self.options["tokenizer"])) for e in r]
+
+
+## lines of the Unchanged entries around each change that midway_changes()
+## splits and shifts over; runs of changes that slide this far make it
+## widen the windows and start over
+SHIFT_MARGIN = 64
+
+
+"""
+the midway text as chunks, the lines of the midway file and of file_b, and
+the changes between them as unified_hunks() takes them.  only the entries
+that are not Unchanged, and up to SHIFT_MARGIN lines of the Unchanged
+entries around them, are split into lines and shifted; the rest stay views
+of the files, so the cost follows the size of the changes.
+"""
+def midway_changes(r, lines_a, lines_b, token_diff=None, jobs=None, verify=None, tokenizer=None, budget=None):
+    hunks = changed_hunks(r, token_diff=token_diff, jobs=jobs, verify=verify, tokenizer=tokenizer, budget=budget)
+    midways = [list(next(hunks)[0]) if e.__class__ == Changed else None for e in r]
+    blank = [blank_entry(e, tokenizer) for e in r]
+    margin = SHIFT_MARGIN
+    while True:
+        result = midway_windows(r, midways, blank, lines_a, lines_b, margin)
+        if result is not None:
+            return result
+        wstats.count("shift_retries")
+        margin = max(8 * margin, 1)
+
+
+"""
+lines of the midway file and of file_b around a run of changes, and which
+of them differ, as compare_sequences() returns them.
+"""
+class Window:
+    def __init__(self, mid_start, b_start):
+        (self.mid_start, self.b_start) = (mid_start, b_start)
+        (self.mid, self.b) = ([], [])
+        (self.changed_mid, self.changed_b) = (bytearray(1), bytearray(1))
+
+    def add(self, mid, b, changed_mid, changed_b):
+        self.mid += mid
+        self.b += b
+        self.changed_mid += changed_mid
+        self.changed_b += changed_b
+
+    """
+    the runs of changes lined up as diff would, or False when one of them
+    reaches an edge of the window with more lines past it.
+    """
+    def shift(self, mid_total, b_total):
+        self.changed_mid.append(0)
+        self.changed_b.append(0)
+        ids = {}
+        mid_ids = [ids.setdefault(x, len(ids)) for x in self.mid]
+        b_ids = [ids.setdefault(x, len(ids)) for x in self.b]
+        shift_boundaries(mid_ids, self.changed_mid, self.changed_b, 0, len(self.mid))
+        shift_boundaries(b_ids, self.changed_b, self.changed_mid, 0, len(self.b))
+        for (start, lines, changed, total) in ((self.mid_start, self.mid, self.changed_mid, mid_total), (self.b_start, self.b, self.changed_b, b_total)):
+            if 0 < start and changed[1] or start + len(lines) < total and changed[len(lines)]:
+                return False
+        return True
+
+
+"""
+midway_changes() with windows of `margin` lines, or None when they are too
+narrow for the shifts.
+"""
+def midway_windows(r, midways, blank, lines_a, lines_b, margin):
+    chunks = []
+    (mid_segments, b_segments) = ([], [])     ## (first line, lines) of the files, in order
+    windows = [Window(0, 0)]
+    pending = None      ## ([midway chunks], [b lines]) of Changed entries not yet diffed
+
+    def flush():
+        m = split_bytes(b"".join(pending[0]))
+        ids = {}
+        (c_mid, c_b) = compare_sequences([ids.setdefault(x, len(ids)) for x in m], [ids.setdefault(x, len(ids)) for x in pending[1]])
+        windows[-1].add(m, pending[1], c_mid[1:-1], c_b[1:-1])
+
+    for (e, a_midway, is_blank) in zip(r, midways, blank):
+        a_lines = strip_line_sentinels(e.a_lines, e.a_start, e.a_end, len(lines_a))
+        b_lines = strip_line_sentinels(e.b_lines, e.b_start, e.b_end, len(lines_b))
+        if e.__class__ == Changed:
+            chunks += a_midway
+            pending = pending or ([], [])
+            pending[0].extend(a_midway)
+            pending[1].extend(b_lines)
+        elif e.__class__ == Unchanged:
+            append_lines(chunks, a_lines)
+            if pending is not None:
+                ## the midway text of a Changed entry may end in the middle
+                ## of a line, which then goes on with the first line here
+                pending[0].extend(a_lines[:1])
+                pending[1].extend(b_lines[:1])
+                flush()
+                pending = None
+                a_lines = a_lines[1:]
+            n = len(a_lines)
+            if n <= 2 * margin:
+                windows[-1].add(list(a_lines), list(a_lines), bytes(n), bytes(n))
+                continue
+            w = windows[-1]
+            w.add(list(a_lines[:margin]), list(a_lines[:margin]), bytes(margin), bytes(margin))
+            mid_segments.append((w.mid_start, w.mid))
+            b_segments.append((w.b_start, w.b))
+            (mid_start, b_start) = (w.mid_start + len(w.mid), w.b_start + len(w.b))
+            keep = 0 if e.b_end == len(lines_b) else margin
+            mid_segments.append((mid_start, a_lines[margin:n - keep]))
+            b_segments.append((b_start, a_lines[margin:n - keep]))
+            windows.append(Window(mid_start + n - margin - keep, b_start + n - margin - keep))
+            windows[-1].add(list(a_lines[n - keep:]), list(a_lines[n - keep:]), bytes(keep), bytes(keep))
+        elif is_blank:
+            ## b's white space lines stand in the midway text, unchanged
+            if e.__class__ == Added:
+                append_lines(chunks, b_lines)
+                if pending is not None:
+                    append_lines(pending[0], b_lines)
+                    pending[1].extend(b_lines)
+                else:
+                    windows[-1].add(list(b_lines), list(b_lines), bytes(len(b_lines)), bytes(len(b_lines)))
+        elif pending is not None:
+            if e.__class__ != Added:
+                append_lines(chunks, a_lines)
+                append_lines(pending[0], a_lines)
+            pending[1].extend(b_lines)
+        elif e.__class__ == Added:
+            windows[-1].add([], list(b_lines), b"", b"\x01" * len(b_lines))
         elif e.__class__ == Deleted:
-            #syslog(LOG_DEBUG, f"@@@ DELETED {e}")
-            a_midway = a_lines if a_start > 0 else a_lines[1:]
-            if a_end == len(lines_a):
-                a_midway = a_midway[:-1]
-            a_mid += a_midway
+            append_lines(chunks, a_lines)
+            windows[-1].add(list(a_lines), [], b"\x01" * len(a_lines), b"")
         else:
             raise Exception("Internal Error")
-    return a_mid
+        if pending is not None and (ends_line(pending[0]) or e.b_end == len(lines_b)):
+            flush()
+            pending = None
+    w = windows[-1]
+    mid_segments.append((w.mid_start, w.mid))
+    b_segments.append((w.b_start, w.b))
+    (mid, b) = (JoinedLines(mid_segments), JoinedLines(b_segments))
+
+    wstats.count("window_lines", sum(len(w.mid) + len(w.b) for w in windows))
+    if not all([w.shift(len(mid), len(b)) for w in windows]):
+        return None
+    changes = []
+    for w in windows:
+        changes += flagged_changes(w.changed_mid, w.changed_b, len(w.mid), len(w.b), w.mid_start, w.b_start)
+    return (chunks, mid, b, changes)
+
 
+"""
+the lines of several sequences (lists or LineViews) one after another, by
+index, without copying them.
+"""
+class JoinedLines:
+    def __init__(self, segments):
+        segments = [(start, lines) for (start, lines) in segments if len(lines) > 0]
+        self.starts = [start for (start, lines) in segments]
+        self.segments = [lines for (start, lines) in segments]
+        self.n = segments[-1][0] + len(segments[-1][1]) if segments else 0
 
-def diff_n(file_a, file_b):
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        k = bisect_right(self.starts, i) - 1
+        return self.segments[k][i - self.starts[k]]
+
+
+def ends_line(chunks):
+    for c in reversed(chunks):
+        if len(c) > 0:
+            return c[-1:] == b"\n"
+    return True
+
+
+def strip_line_sentinels(lines, start, end, n):
+    if start == 0:
+        lines = lines[1:]
+    if end == n:
+        lines = lines[:-1]
+    return lines
+
+
+"""
+format changes as unified diff hunks with `context` lines of context and,
+like `diff -p`, the last line before each hunk that looks like the start
+of a C function.
+"""
+def unified_hunks(a, b, changed_a, changed_b, context=3):
+    return changes_to_hunks(a, b, flagged_changes(changed_a, changed_b, len(a), len(b)), context)
+
+
+"""
+[(line_a, deleted, line_b, inserted)], 0-based, of the runs of changed
+flags of n_a and n_b lines that start at lines a_lo and b_lo of the files.
+"""
+def flagged_changes(changed_a, changed_b, n_a, n_b, a_lo=0, b_lo=0):
+    changes = []
+    (i, j) = (0, 0)
+    while i < n_a or j < n_b:
+        if not changed_a[i + 1] and not changed_b[j + 1]:
+            i += 1
+            j += 1
+            continue
+        (i0, j0) = (i, j)
+        while changed_a[i + 1]:
+            i += 1
+        while changed_b[j + 1]:
+            j += 1
+        changes.append((a_lo + i0, i - i0, b_lo + j0, j - j0))
+    return changes
+
+
+"""
+unified diff hunks of the changes of a to b that flagged_changes() lists.
+"""
+def changes_to_hunks(a, b, changes, context=3):
+    out = []
+    function_search = [0, None]     ## (where the last search started, last match)
+    k = 0
+    while k < len(changes):
+        ## changes less than 2 * context + 1 lines apart share a hunk
+        first = k
+        while k + 1 < len(changes) and changes[k + 1][0] - (changes[k][0] + changes[k][1]) < 2 * context + 1:
+            k += 1
+        hunk = changes[first:k + 1]
+        k += 1
+
+        (first_a, first_b) = (max(hunk[0][0] - context, 0), max(hunk[0][2] - context, 0))
+        last_a = min(hunk[-1][0] + hunk[-1][1] - 1 + context, len(a) - 1)
+        last_b = min(hunk[-1][2] + hunk[-1][3] - 1 + context, len(b) - 1)
+
+        header = b"@@ -" + unified_range(first_a, last_a) + b" +" + unified_range(first_b, last_b) + b" @@"
+        function = find_function(a, first_a, function_search)
+        if function is not None:
+            header += b" " + function
+        out.append(header + b"\n")
+
+        (i, j) = (first_a, first_b)
+        for (line_a, deleted, line_b, inserted) in hunk + [(last_a + 1, 0, last_b + 1, 0)]:
+            while i < line_a:
+                out += unified_line(b" ", a[i])
+                i += 1
+                j += 1
+            for i in range(i, i + deleted):
+                out += unified_line(b"-", a[i])
+            i = line_a + deleted
+            for j in range(j, j + inserted):
+                out += unified_line(b"+", b[j])
+            j = line_b + inserted
+    return out
+
+
+def unified_range(first, last):
+    (first, last) = (first + 1, last + 1)
+    if last < first:
+        return b"%d,0" % last
+    if last == first:
+        return b"%d" % last
+    return b"%d,%d" % (first, last - first + 1)
+
+
+def unified_line(prefix, line):
+    if line.endswith(b"\n"):
+        return [prefix, line]
+    return [prefix, line, b"\n\\ No newline at end of file\n"]
+
+
+c_function_pattern = re.compile(br"[A-Za-z$_]")
+
+## diff matches [[:alpha:]$_] in the locale, so in a UTF-8 locale a line
+## starting with a non-ASCII letter counts too
+function_utf8 = locale.nl_langinfo(locale.CODESET) == "UTF-8"
+
+"""
+the line diff -p shows after the hunk range: the closest line above
+`first` that starts with a letter, '$' or '_', searched no further back
+than the previous search, trimmed to 40 bytes.
+"""
+def find_function(lines, first, search):
+    (last, match) = search
+    search[0] = first
+    for i in range(first - 1, last - 1, -1):
+        if is_function_line(lines[i]):
+            search[1] = i
+            match = i
+            break
+    if match is None:
+        return None
+    line = lines[match].rstrip(b"\n")[:40]
+    return line.rstrip(b" \t\n\v\f\r")
+
+
+def is_function_line(line):
+    if c_function_pattern.match(line):
+        return True
+    return function_utf8 and line[:1] >= b"\x80" and bytes(line[:4]).decode("utf-8", "replace")[:1].isalpha()
+
+
+def append_lines(a_mid, lines):
+    if lines.__class__ == LineView:
+        a_mid.append(lines.body())      ## one zero-copy chunk instead of a bytes per line
+    else:
+        a_mid += lines
+
+
+"""
+the lines are diffed by the line_diff backend (LINE_DIFF unless given):
+in-process by diff_lines(), or by `diff -n`.
+with a deadline (time.monotonic()), the diff is stopped when it passes and
+OverBudget is raised.  binary files are not read, and identical files are
+not diffed: check is what precheck() returned, when the caller ran it.
+the lines the files begin and end with in common are left out of the
+diff, which gets only the middles (see common_ends()).  with patch, a
+unified diff of the files (`git diff -U0`), the changelist is made from
+its hunks and diff is not run (see patch_to_changelist()).
+"""
+def diff_n(file_a, file_b, verify=None, deadline=None, check=False, patch=None, line_diff=None):
+    if check is False:
+        check = precheck(file_a, file_b)
+    if check == "binary":
+        return (None, None, None, None, None)
     (raw_a, lines_a) = readfile(file_a)
     (raw_b, lines_b) = readfile(file_b)
-    cmd = ["diff", "-n", file_a, file_b]
-    with Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE) as p:
+    if check == "same":
+        return (rcs_format_to_changelist(b"", lines_a, lines_b, raw_a, raw_b, verify=verify), lines_a, lines_b, raw_a, raw_b)
+    if patch is not None:
+        return (patch_to_changelist(patch, lines_a, lines_b, verify=verify), lines_a, lines_b, raw_a, raw_b)
+    ends = common_ends(raw_a, lines_a, raw_b, lines_b)
+    (head, tail, head_bytes, tail_bytes) = ends
+    line_diff = line_diff or LINE_DIFF
+    if line_diff == "auto":
+        line_diff = "myers" if len(lines_a) + len(lines_b) - 4 - 2 * (head + tail) < LINE_DIFF_MAX else "diff"
+    if line_diff == "myers":
+        wstats.count("trimmed_lines", head + tail)
+        with wstats.timer("line_diff"):
+            r = diff_lines(lines_a, lines_b, head, tail, deadline=deadline)
+        return (r, lines_a, lines_b, raw_a, raw_b)
+    if head == 0 and tail == 0:
+        out = run_diff_n(file_a, file_b, deadline)
+    else:
+        wstats.count("trimmed_lines", head + tail)
         try:
-            (out, err) = p.communicate()
+            mid_a = write_tokens_to_tempfile([memoryview(raw_a)[head_bytes:len(raw_a) - tail_bytes]])
+            mid_b = write_tokens_to_tempfile([memoryview(raw_b)[head_bytes:len(raw_b) - tail_bytes]])
+            out = run_diff_n(mid_a, mid_b, deadline)
+        finally:
+            os.unlink(mid_a)
+            os.unlink(mid_b)
+    return (rcs_format_to_changelist(out, lines_a, lines_b, raw_a, raw_b, verify=verify, ends=ends), lines_a, lines_b, raw_a, raw_b)
+
+
+"""
+the output of `diff -a -n file_a file_b`.  whether the files are binary
+is decided once, by precheck() on the whole files: the middles diffed here
+are text even when a NUL past the first block lands near their start.
+"""
+def run_diff_n(file_a, file_b, deadline=None):
+    cmd = ["diff", "-a", "-n", file_a, file_b]
+    with wstats.timer("diff"), Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE) as p:
+        try:
+            (out, err) = p.communicate(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
             p.wait()
+        except TimeoutExpired:
+            p.kill()
+            p.communicate()
+            raise OverBudget("seconds")
         except Exception as e:
             syslog(LOG_ERR, f"{e}")
             raise
-    return (rcs_format_to_changelist(out, lines_a, lines_b, raw_a, raw_b), lines_a, lines_b, raw_a, raw_b)
+    return out
+
+
+"""
+(head, tail, head_bytes, tail_bytes): the lines that raw_a and raw_b begin
+and end with in common, found by comparing the buffers in blocks, and their
+bytes.  the head and the tail are whole lines and do not overlap, as with
+the identical ends diff itself skips, so a diff of the middles lines up
+the same.
+"""
+def common_ends(raw_a, lines_a, raw_b, lines_b):
+    n = min(len(raw_a), len(raw_b))
+    head_bytes = raw_a.rfind(b"\n", 0, common_length(raw_a, raw_b, n)) + 1
+    tail_bytes = common_length(raw_a, raw_b, n - head_bytes, from_end=True)
+    (start_a, start_b) = (len(raw_a) - tail_bytes, len(raw_b) - tail_bytes)
+    if not (raw_a[start_a - 1:start_a] in (b"", b"\n") and raw_b[start_b - 1:start_b] in (b"", b"\n")):
+        newline = raw_a.find(b"\n", start_a)      ## the tail starts after the first newline in it
+        tail_bytes = len(raw_a) - newline - 1 if 0 <= newline else 0
+    head = lines_before(raw_a, lines_a, head_bytes)
+    tail = len(lines_a) - 2 - lines_before(raw_a, lines_a, len(raw_a) - tail_bytes) if 0 < tail_bytes else 0
+    return (head, tail, head_bytes, tail_bytes)
+
+
+"""
+the length of the common prefix of two buffers (bytes or mmap), or of the
+common suffix, up to n: compared a block at a time, then bisected in the
+block that differs.  slices of a block are copied, which is cheaper than
+comparing memoryviews.
+"""
+def common_length(raw_a, raw_b, n, from_end=False):
+    def same(lo, hi):
+        if from_end:
+            return raw_a[len(raw_a) - hi:len(raw_a) - lo] == raw_b[len(raw_b) - hi:len(raw_b) - lo]
+        return raw_a[lo:hi] == raw_b[lo:hi]
+
+    lo = 0
+    while lo < n:
+        hi = min(lo + TRIM_BLOCK, n)
+        if not same(lo, hi):
+            while lo + 1 < hi:
+                mid = (lo + hi) // 2
+                if same(lo, mid):
+                    lo = mid
+                else:
+                    hi = mid
+            return lo
+        lo = hi
+    return n
+
+
+TRIM_BLOCK = 64 << 10
+
+
+"""
+the number of lines of raw before `offset`, which starts a line.
+"""
+def lines_before(raw, lines, offset):
+    if lines.__class__ == LineView:
+        return bisect_left(lines.offsets, offset)
+    return raw.count(b"\n", 0, offset)
+
+
+"""
+diff_n() of two buffers, in-process.
+"""
+def diff_buffers(raw_a, raw_b, patch=None):
+    if is_binary(raw_a, raw_b):
+        return (None, None, None, raw_a, raw_b)
+    (lines_a, lines_b) = (buffer_lines(raw_a), buffer_lines(raw_b))
+    if patch is not None:
+        return (patch_to_changelist(patch, lines_a, lines_b), lines_a, lines_b, raw_a, raw_b)
+    with wstats.timer("line_diff"):
+        r = diff_sequences(lines_a, lines_b)
+    return (r, lines_a, lines_b, raw_a, raw_b)
+
+
+## diff takes files with a NUL in their first block as binary
+BINARY_SNIFF = 4096
+
+def is_binary(raw_a, raw_b):
+    if b"\0" not in bytes(raw_a[:BINARY_SNIFF]) and b"\0" not in bytes(raw_b[:BINARY_SNIFF]):
+        return False
+    return memoryview(raw_a) != memoryview(raw_b)
+
+
+"""
+what two files are, from their sizes, first blocks and, when those agree,
+their bytes, before they are read: "same" when their bytes are equal,
+"binary" when they differ and either has a NUL in its first block, as diff
+decides, and None otherwise.
+"""
+def precheck(file_a, file_b):
+    with wstats.timer("precheck"), open(file_a, "rb") as f_a, open(file_b, "rb") as f_b:
+        (size_a, size_b) = (os.fstat(f_a.fileno()).st_size, os.fstat(f_b.fileno()).st_size)
+        (head_a, head_b) = (f_a.read(BINARY_SNIFF), f_b.read(BINARY_SNIFF))
+        nul = b"\0" in head_a or b"\0" in head_b
+        if size_a != size_b or head_a != head_b:
+            same = False
+        elif size_a <= BINARY_SNIFF:
+            same = True
+        else:
+            with mmap.mmap(f_a.fileno(), 0, access=mmap.ACCESS_READ) as map_a, mmap.mmap(f_b.fileno(), 0, access=mmap.ACCESS_READ) as map_b:
+                with memoryview(map_a) as view_a, memoryview(map_b) as view_b:
+                    same = view_a == view_b
+    if same:
+        wstats.count("precheck_same")
+        return "same"
+    if nul:
+        wstats.count("precheck_binary")
+        return "binary"
+    return None
+
+
+"""
+whether the sensible tokens of two files that precheck() let through are
+the same, when WHITESPACE_CHECK is on.  the files are mapped, not read.
+"""
+def whitespace_only(file_a, file_b, tokenizer=None):
+    if not WHITESPACE_CHECK:
+        return False
+    with open(file_a, "rb") as f_a, open(file_b, "rb") as f_b:
+        raws = [mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > 0 else b"" for f in (f_a, f_b)]
+        try:
+            same = same_tokens(raws[0], raws[1], tokenizer)
+        finally:
+            for raw in raws:
+                if raw.__class__ == mmap.mmap:
+                    raw.close()
+    if same:
+        wstats.count("whitespace_files")
+    return same
+
+
+"""
+whether raw_a and raw_b have the same sensible tokens, as changed() would
+compare them.  the bytes without white space are compared first, which is
+cheap and settles most pairs.  when they are equal and no sensible token
+has white space in it, the sensible tokens are those bytes, so the lengths
+of the tokens settle the rest; otherwise the tokens themselves are
+compared.  all of it runs a block at a time, so memory stays flat and
+each comparison stops at the first difference.
+"""
+def same_tokens(raw_a, raw_b, tokenizer=None):
+    with wstats.timer("whitespace_check"):
+        space = space_bytes(tokenizer)
+        if not same_blocks(nonspace_blocks(raw_a, space), nonspace_blocks(raw_b, space)):
+            return False
+        spaced = []
+        if not same_blocks(token_lengths(raw_a, tokenizer, spaced), token_lengths(raw_b, tokenizer, spaced)):
+            return False
+        return not spaced or same_blocks(token_bytes(raw_a, tokenizer), token_bytes(raw_b, tokenizer))
+
+
+def space_bytes(tokenizer=None):
+    return bytes(c for c in range(256) if (tokenizer or c_tokenizer).table[c] == b" "[0])
+
+
+"""
+whether two iterators of blocks (bytes, arrays or lists) have the same
+concatenation, however the blocks are cut.
+"""
+def same_blocks(blocks_a, blocks_b):
+    (a, b) = ([], [])
+    while True:
+        while a is not None and len(a) == 0:
+            a = next(blocks_a, None)
+        while b is not None and len(b) == 0:
+            b = next(blocks_b, None)
+        if a is None or b is None:
+            return a is None and b is None
+        n = min(len(a), len(b))
+        if a[:n] != b[:n]:
+            return False
+        (a, b) = (a[n:], b[n:])
+
+
+def nonspace_blocks(raw, space):
+    for start in range(0, len(raw), TOKEN_BLOCK):
+        yield bytes(raw[start:start + TOKEN_BLOCK]).translate(None, space)
+
+
+"""
+the lengths of the sensible tokens of raw, block by block.  a True is
+appended to `spaced` when one of them has white space in it.
+"""
+def token_lengths(raw, tokenizer, spaced):
+    for (buf, classes) in token_blocks(raw, tokenizer):
+        sensible = list(filterfalse(bytes.isspace, classes))
+        if b" " in b"".join(sensible):
+            spaced.append(True)
+        yield array("I", map(len, sensible))
+
+
+def token_bytes(raw, tokenizer):
+    for (buf, classes) in token_blocks(raw, tokenizer):
+        bounds = list(accumulate(map(len, classes), initial=0))
+        yield [buf[bounds[i]:bounds[i + 1]] for i in range(len(classes)) if not classes[i].isspace()]
+
+
+"""
+(buf, classes) for blocks of about TOKEN_BLOCK bytes of raw, classes being
+what the tokenizer's pattern finds in buf, as in token_bounds().  the last
+token of a block may go on in the next one, so it is left to the next
+block, which starts with it.
+"""
+def token_blocks(raw, tokenizer=None):
+    (name, table, pattern) = tokenizer or c_tokenizer
+    start = 0
+    size = TOKEN_BLOCK
+    while start < len(raw):
+        end = min(start + size, len(raw))
+        buf = bytes(raw[start:end])
+        classes = pattern.findall(buf.translate(table))
+        if end < len(raw):
+            if len(classes) == 1:
+                size *= 2       ## a token longer than the block
+                continue
+            classes.pop()
+        yield (buf, classes)
+        start += sum(map(len, classes))
+        size = TOKEN_BLOCK
+
+
+"""
+sentinel-wrapped lines of a buffer, as readfile() returns them.
+"""
+def buffer_lines(raw):
+    if raw.__class__ == mmap.mmap:
+        return LineView(raw, line_offsets(raw))
+    raw = bytes(raw)
+    if LARGE_FILE <= len(raw):
+        return LineView(raw, line_offsets(raw))
+    return [b"^\n"] + split_bytes(raw) + [b"$\n"]
 
 
 def readfile(path):
     try:
+        size = os.path.getsize(path)
+        if 0 < size and LARGE_FILE <= size:
+            return mapfile(path)
         with open(path, "rb") as f:
             raw = f.read()
-            #f.seek(0)
-            #lines0 = f.readlines()                   ## preserve '\n'
-            #lines0 = s.strip().splitlines()   ## strip '\n'
             #lines = [e for e in re.split(br'([^\n]+\n)', s) if e != b''] ## keep '\r'
             #lines = s.split(b'\n')
             #lines = [e for e in re.split(br'([^\n]+\n)', s) if e != b''] ## keep '\r'
             lines = split_bytes(raw)
-            #syslog(LOG_DEBUG, f"{len(lines0)} {len(lines)}")
-            #for (e0, e1) in zip(lines0, lines):
-            #    if e0 != e1:
-            #        syslog(LOG_DEBUG, f"DIFFER: {e0} {e1}")
+        wstats.count("bytes_read", len(raw))
+        wstats.count("lines", len(lines))
     except Exception as e:
         syslog(LOG_ERR, f"{e}")
         raise
@@ -107,24 +1015,152 @@ def readfile(path):
     return (raw, add_sentinel(lines))
 
 
+"""
+readfile() for large files: the file is memory-mapped and its lines are a
+LineView of line offsets, so neither the contents nor the lines are copied.
+"""
+def mapfile(path):
+    try:
+        with open(path, "rb") as f:
+            raw = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception as e:
+        syslog(LOG_ERR, f"{e}")
+        raise
+    lines = LineView(raw, line_offsets(raw))
+    wstats.count("bytes_read", len(raw))
+    wstats.count("lines", len(lines) - 2)
+    return (raw, lines)
+
+
+"""
+sentinel-wrapped lines of a buffer, as readfile() returns them, without
+copying the buffer.  line i (0 < i < len - 1) is buf[offsets[i - 1]:offsets[i]].
+slicing gives another view of the same buffer, so changelist entries refer
+to ranges instead of holding copies of the lines.
+"""
+class LineView:
+    def __init__(self, buf, offsets, start=0, stop=None):
+        self.buf = buf
+        self.offsets = offsets
+        self.start = start
+        self.stop = len(offsets) + 1 if stop is None else stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            (start, stop, step) = k.indices(len(self))
+            assert step == 1
+            return LineView(self.buf, self.offsets, self.start + start, self.start + max(start, stop))
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError(k)
+        return self.line(self.start + k)
+
+    def __iter__(self):
+        return map(self.line, range(self.start, self.stop))
+
+    def line(self, i):
+        if i == 0:
+            return b"^\n"
+        if i == len(self.offsets):
+            return b"$\n"
+        return self.buf[self.offsets[i - 1]:self.offsets[i]]
+
+    """
+    the lines as one memoryview of the buffer, sentinels excluded.
+    """
+    def body(self):
+        (lo, hi) = self.body_range()
+        return memoryview(self.buf)[lo:hi]
+
+    def body_range(self):
+        first = max(self.start, 1)
+        last = min(self.stop, len(self.offsets))
+        if last <= first:
+            return (0, 0)
+        return (self.offsets[first - 1], self.offsets[last - 1])
+
+    """
+    compares a block of bytes at a time instead of line by line.
+    the same bytes split into the same lines, so this is list equality.
+    """
+    def __eq__(self, other):
+        if other.__class__ != LineView:
+            return list(self) == list(other)
+        if len(self) != len(other):
+            return False
+        if (self.start == 0) != (other.start == 0) or (self.stop == len(self.offsets) + 1) != (other.stop == len(other.offsets) + 1):
+            return False
+        ((lo, hi), (other_lo, other_hi)) = (self.body_range(), other.body_range())
+        if hi - lo != other_hi - other_lo:
+            return False
+        for pos in range(0, hi - lo, LINE_OFFSETS_BLOCK):
+            n = min(LINE_OFFSETS_BLOCK, hi - lo - pos)
+            if self.buf[lo + pos:lo + pos + n] != other.buf[other_lo + pos:other_lo + pos + n]:
+                return False
+        return True
+
+
 """
 split lines by '\n', and retain '\n'.
 '\r' is normal character that has no special meanings.
 """
 def split_bytes(s):
-    r = []
-    l = []
-    for c in s:
-        l.append(c)
-        if c == b'\n'[0]:
-            r.append(bytes(l))
-            l = []
-    if l != []:
-        r.append(bytes(l))
-    return r
+    if b"\r" not in s:
+        return s.splitlines(keepends=True)  ## same rule as long as there is no '\r'
+    return line_pattern.findall(s)
+
+
+line_pattern = re.compile(br"[^\n]*\n|[^\n]+")
+
+
+"""
+line boundaries of s, by the same rule as split_bytes().
+line i is s[offsets[i]:offsets[i + 1]], so callers can take zero-copy
+slices through memoryview(s).  s is any bytes-like object (bytes, mmap, ...)
+"""
+def line_offsets(s):
+    if isinstance(s, bytes):
+        offsets = array("Q", accumulate(map(len, split_bytes(s)), initial=0))
+    else:
+        ## a block at a time, so that only one block is copied out of s
+        offsets = array("Q", [0])
+        pos = 0
+        while pos < len(s):
+            block = bytes(s[pos:pos + LINE_OFFSETS_BLOCK])
+            if pos + len(block) == len(s):
+                cut = len(block)
+            else:
+                cut = block.rfind(b"\n") + 1
+            if 0 < cut:
+                ends = accumulate(map(len, split_bytes(block[:cut])), initial=pos)
+                next(ends)
+                offsets.extend(ends)
+                pos += cut
+            else:
+                pos += len(block)       ## inside a line longer than the block
+    return offsets
 
 
-def rcs_format_to_changelist(out, lines_a, lines_b, raw_a, raw_b):
+LINE_OFFSETS_BLOCK = 1 << 20
+
+
+"""
+the changelist of `diff -n` output.  with ends (see common_ends()), out is
+the diff of the middles of the files, and its line numbers are shifted by
+the head; the head and the tail are equal by construction, so they are not
+verified.
+"""
+def rcs_format_to_changelist(out, lines_a, lines_b, raw_a, raw_b, verify=None, ends=None):
+    (head, tail) = ends[:2] if ends else (0, 0)
+
+    def same_lines(a_lo, a_hi, b_lo):
+        (lo, hi) = (max(a_lo, head + 1), min(a_hi, len(lines_a) - 1 - tail))
+        return hi <= lo or all(compare_list(lines_a[lo:hi], lines_b[lo - a_lo + b_lo:hi - a_lo + b_lo]))
+
     r = []
     add_n_lines = 0
     added_lines = 0
@@ -149,9 +1185,10 @@ def rcs_format_to_changelist(out, lines_a, lines_b, raw_a, raw_b):
                 if atype == Added:
                     assert add_n_lines == len(al)
                     b_lines = lines_b[b_start:b_end]
-                    if not all(compare_list(al, b_lines)):
-                        syslog(LOG_DEBUG, f"COMPARE_LIST FAILED {al} {b_lines} while processing {sys.argv}")
-                    assert all(compare_list(al, b_lines))
+                    if verifying(verify):
+                        if not all(compare_list(al, b_lines)):
+                            syslog(LOG_DEBUG, f"COMPARE_LIST FAILED {al} {b_lines} while processing {sys.argv}")
+                        assert all(compare_list(al, b_lines))
                     r.append(Added(e0, a_start, a_start, [], b_start, b_end, al))
                 elif atype == Changed:
                     d = r.pop()
@@ -166,9 +1203,11 @@ def rcs_format_to_changelist(out, lines_a, lines_b, raw_a, raw_b):
         elif e.startswith(b"a"):
             command = (lineno, e)
             ee = e.split(b' ')
-            a_start = int(ee[0][1:])        ## a_start行の次に
+            a_start = int(ee[0][1:]) + head ## a_start行の次に
             add_n_lines = int(ee[1])        ## add_n_lines行追加
             added_lines = 0
+            if head:
+                e = b"a%d %d\n" % (a_start, add_n_lines)
 
             a_start += 1                    ##
 
@@ -180,7 +1219,7 @@ def rcs_format_to_changelist(out, lines_a, lines_b, raw_a, raw_b):
                 b_start = a_start - a_end + b_end
                 a_lines = lines_a[a_end:a_start]
                 b_lines = lines_b[b_end:b_start]
-                assert all(compare_list(a_lines, b_lines))
+                assert not verifying(verify) or same_lines(a_end, a_start, b_end)
                 r.append(Unchanged(None, a_end, a_start, a_lines, b_end, b_start, b_lines))
                 atype = Added
                 a_end = a_start
@@ -193,14 +1232,16 @@ def rcs_format_to_changelist(out, lines_a, lines_b, raw_a, raw_b):
         elif e.startswith(b"d"):
             command = (lineno, e)
             ee = e.split(b' ')
-            a_start = int(ee[0][1:])        ## a_start行から
+            a_start = int(ee[0][1:]) + head ## a_start行から
             delete_n_lines = int(ee[1])     ## delete_n_lines行削除
+            if head:
+                e = b"d%d %d\n" % (a_start, delete_n_lines)
 
             if a_end < a_start:
                 b_start = a_start - a_end + b_end
                 a_lines = lines_a[a_end:a_start]
                 b_lines = lines_b[b_end:b_start]
-                assert all(compare_list(a_lines, b_lines))
+                assert not verifying(verify) or same_lines(a_end, a_start, b_end)
                 r.append(Unchanged(None, a_end, a_start, a_lines, b_end, b_start, b_lines))
                 a_end = a_start
                 b_end = b_start
@@ -223,7 +1264,7 @@ def rcs_format_to_changelist(out, lines_a, lines_b, raw_a, raw_b):
         a_lines = lines_a[a_end:a_start]
         b_start = a_start - a_end + b_end
         b_lines = lines_b[b_end:b_start]
-        assert all(compare_list(a_lines, b_lines))
+        assert not verifying(verify) or same_lines(a_end, a_start, b_end)
         r.append(Unchanged(None, a_end, a_start, a_lines, b_end, b_start, b_lines))
 
     a_end = 0
@@ -240,152 +1281,671 @@ def rcs_format_to_changelist(out, lines_a, lines_b, raw_a, raw_b):
     return r
 
 
-def changed(c):
-    #syslog(LOG_DEBUG, f"@@@@@@ CHG: {c}")
-    assert c.__class__ == Changed
-    (diff_command, a_start, a_end, a_lines, b_start, b_end, b_lines) = c
-    #syslog(LOG_DEBUG, f"a_start = {a_start} a_end = {a_end} b_start = {b_start} b_end = {b_end}")
+"""
+the changelist of a unified diff of the lines, as git prints it (with any
+number of context lines; headers before the first hunk are skipped), in
+place of `diff -n`.  its alignment is git's, which may differ from diff's
+where several are equally short.  returns None for a binary patch.  the
+hunks must add up to the lines, and with verify their lines must be the
+lines they refer to; otherwise an Exception is raised.
+"""
+def patch_to_changelist(patch, lines_a, lines_b, verify=None):
+    changed_a = bytearray(len(lines_a))
+    changed_b = bytearray(len(lines_b))
+    (a_end, b_end) = (1, 1)     ## past the last hunk, in sentinel-wrapped lines
+    df = split_bytes(patch)
+    k = 0
+    while k < len(df):
+        m = hunk_header.match(df[k])
+        k += 1
+        if m is None:
+            if df[k - 1].startswith(b"Binary files") and a_end == 1:
+                return None
+            continue
+        (a_count, b_count) = (int(m[2] or 1), int(m[4] or 1))
+        a_pos = int(m[1]) + (a_count == 0)      ## "-5,0" is after line 5
+        b_pos = int(m[3]) + (b_count == 0)
+        if a_pos - a_end != b_pos - b_end or a_pos < a_end:
+            raise Exception(f"patch does not match the files at {df[k - 1]}")
+        while 0 < a_count or 0 < b_count:
+            if len(df) <= k:
+                raise Exception("patch ends inside a hunk")
+            line = df[k]
+            k += 1
+            tag = line[:1]
+            if tag == b"\\":       ## \ No newline at end of file
+                continue
+            if tag in (b" ", b"-"):
+                if not a_pos < len(lines_a) - 1 or verifying(verify) and not same_patch_line(line, lines_a[a_pos]):
+                    raise Exception(f"patch does not match file a at line {a_pos}")
+                changed_a[a_pos] = tag == b"-"
+                (a_pos, a_count) = (a_pos + 1, a_count - 1)
+            if tag in (b" ", b"+"):
+                if not b_pos < len(lines_b) - 1 or verifying(verify) and not same_patch_line(line, lines_b[b_pos]):
+                    raise Exception(f"patch does not match file b at line {b_pos}")
+                changed_b[b_pos] = tag == b"+"
+                (b_pos, b_count) = (b_pos + 1, b_count - 1)
+            if tag not in (b" ", b"-", b"+"):
+                raise Exception(f"GARBAGE in hunk: {line}")
+        (a_end, b_end) = (a_pos, b_pos)
+    if len(lines_a) - a_end != len(lines_b) - b_end:
+        raise Exception("patch does not match the files at the end")
+    wstats.count("patch_hunks", sum(1 for e in df if e.startswith(b"@@")))
+    return changed_to_changelist(changed_a, changed_b, lines_a, lines_b)
+
+
+hunk_header = re.compile(br"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
 
-    a_raw_tokens = tokenize(b''.join(a_lines))
-    b_raw_tokens = tokenize(b''.join(b_lines))
-    a_sensible = [Sensible(i, token, start, end) for (i, (token, start, end)) in enumerate(a_raw_tokens) if not isspaces(token)]
-    b_sensible = [Sensible(i, token, start, end) for (i, (token, start, end)) in enumerate(b_raw_tokens) if not isspaces(token)]
 
-    try:
-        file_a = write_tokens_to_tempfile([token for (i, token, start, end) in a_sensible], end=b"\n")
-        file_b = write_tokens_to_tempfile([token for (i, token, start, end) in b_sensible], end=b"\n")
+"""
+a line of a hunk is the line of the file after its tag, though the last
+line of a file may have no newline (the hunk then says so on the next line).
+"""
+def same_patch_line(line, file_line):
+    return line[1:] == file_line or line[1:] == file_line + b"\n"
 
-        #lines_a = readfile(file_a)
-        #lines_b = readfile(file_b)
-        #lines_a = add_sentinel(a_flat)
-        #lines_b = add_sentinel(b_flat)
-        #syslog(LOG_DEBUG, f"@@@ COMPARE {compare_list(lines_a, add_sentinel(a_flat))}")
-        #syslog(LOG_DEBUG, f"@@@ COMPARE {compare_list(lines_b, add_sentinel(b_flat))}")
-        (r, lines_a, lines_b, raw_a, raw_b) = diff_n(file_a, file_b)
 
-    finally:
-        os.unlink(file_a)
-        os.unlink(file_b)
+"""
+diff two sentinel-wrapped line lists (as readfile() returns them) in-process.
+returns the same changelist as rcs_format_to_changelist() returns for
+`diff -n` over the lines without the sentinels.
+lines are interned to integer ids, then compared the way GNU diff does
+(Myers' O(ND) algorithm split on middle snakes, discarding of confusing
+lines, boundary shifting), so the alignment is the one the external diff
+chooses.  GNU diff's too_expensive heuristic, which only kicks in past an
+edit cost of 4096, is not implemented.  past `deadline` (time.monotonic())
+OverBudget is raised.
+"""
+def diff_sequences(lines_a, lines_b, anchored=False, deadline=None):
+    ids = {}
+    a = [ids.setdefault(e, len(ids)) for e in lines_a[1:-1]]
+    b = [ids.setdefault(e, len(ids)) for e in lines_b[1:-1]]
+    if anchored:
+        (changed_a, changed_b) = compare_anchored(a, b, deadline=deadline)
+    else:
+        (changed_a, changed_b) = compare_sequences(a, b, deadline=deadline)
+    return changed_to_changelist(changed_a, changed_b, lines_a, lines_b)
 
-    def add_sentinel(tokens, raw_tail_index):
-        return [Sensible(0, b"^", None, None)] + tokens + [Sensible(raw_tail_index, b"$", None, None)]
 
-    a_sensible_ws = add_sentinel(a_sensible, len(a_raw_tokens))
-    b_sensible_ws = add_sentinel(b_sensible, len(b_raw_tokens))
+"""
+diff_sequences() of the lines between the `head` and `tail` lines the two
+files begin and end with in common (see common_ends()), which are left
+unchanged and are not interned.  each line is hashed once, as it goes into
+the table of ids.
+"""
+def diff_lines(lines_a, lines_b, head, tail, deadline=None):
+    ids = {}
+    a = [ids.setdefault(e, len(ids)) for e in lines_a[head + 1:len(lines_a) - 1 - tail]]
+    b = [ids.setdefault(e, len(ids)) for e in lines_b[head + 1:len(lines_b) - 1 - tail]]
+    wstats.count("line_ids", len(ids))
+    (c_a, c_b) = compare_sequences(a, b, deadline=deadline)
+    changed_a = bytearray(len(lines_a))
+    changed_b = bytearray(len(lines_b))
+    changed_a[head + 1:head + 1 + len(a)] = c_a[1:-1]
+    changed_b[head + 1:head + 1 + len(b)] = c_b[1:-1]
+    return changed_to_changelist(changed_a, changed_b, lines_a, lines_b)
 
-    s_sentinel = Token(b'^', None, None)
-    e_sentinel = Token(b'$', None, None)
 
-    a_raw_tokens_ws = [s_sentinel] + a_raw_tokens + [e_sentinel]
-    b_raw_tokens_ws = [s_sentinel] + b_raw_tokens + [e_sentinel]
+"""
+compare_sequences() split on anchors: elements that occur exactly once in
+a and once in b, and of those the longest run in the same order on both
+sides (patience diff).  the anchors are kept, the pieces between them are
+compared on their own, recursively while they are ANCHOR_MIN long, and the
+boundaries are shifted over the whole sequences at the end.  the cost is
+bounded by the pieces instead of the whole, at the price of an alignment
+that may differ from diff's.
+"""
+def compare_anchored(a, b, deadline=None):
+    changed_a = bytearray(len(a) + 2)
+    changed_b = bytearray(len(b) + 2)
+    pieces = [(0, len(a), 0, len(b))]
+    while pieces:
+        (a_lo, a_hi, b_lo, b_hi) = pieces.pop()
+        anchors = unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi) if ANCHOR_MIN <= a_hi - a_lo + b_hi - b_lo else []
+        if anchors == []:
+            (c_a, c_b) = compare_sequences(a[a_lo:a_hi], b[b_lo:b_hi], deadline=deadline)
+            changed_a[a_lo + 1:a_hi + 1] = c_a[1:-1]
+            changed_b[b_lo + 1:b_hi + 1] = c_b[1:-1]
+            continue
+        wstats.count("anchors", len(anchors))
+        for (i, j) in anchors + [(a_hi, b_hi)]:
+            if a_lo < i or b_lo < j:
+                pieces.append((a_lo, i, b_lo, j))
+            (a_lo, b_lo) = (i + 1, j + 1)
+
+    shift_boundaries(a, changed_a, changed_b, 0, len(a))
+    shift_boundaries(b, changed_b, changed_a, 0, len(b))
+    return (changed_a, changed_b)
 
-    #syslog(LOG_DEBUG, f"@@@ @@@ @@@ X: a_sensible_ws={a_sensible_ws}")
-    #syslog(LOG_DEBUG, f"@@@ @@@ @@@ X: b_sensible_ws={b_sensible_ws}")
-    #syslog(LOG_DEBUG, f"@@@ @@@ @@@ X: a_raw_tokens_ws={a_raw_tokens_ws}")
-    #syslog(LOG_DEBUG, f"@@@ @@@ @@@ X: b_raw_tokens_ws={b_raw_tokens_ws}")
 
-    prev_a_start = 0
-    prev_b_start = 0
+"""
+[(i, j)] with a[i] == b[j] occurring once in a[a_lo:a_hi] and once in
+b[b_lo:b_hi], the longest list of them increasing in both i and j.
+"""
+def unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi):
+    (first_a, first_b) = ({}, {})       ## element -> its index, or -1 when repeated
+    for (first, seq, lo, hi) in ((first_a, a, a_lo, a_hi), (first_b, b, b_lo, b_hi)):
+        for k in range(lo, hi):
+            first[seq[k]] = -1 if seq[k] in first else k
+    pairs = [(i, first_b[a[i]]) for i in range(a_lo, a_hi) if first_a[a[i]] == i and 0 <= first_b.get(a[i], -1)]
+
+    ## longest increasing subsequence of j by patience sorting
+    tops = []           ## smallest j ending an increasing run of each length
+    top_pairs = []      ## index in pairs of that j
+    back = [None] * len(pairs)
+    for (k, (i, j)) in enumerate(pairs):
+        n = bisect_left(tops, j)
+        back[k] = top_pairs[n - 1] if 0 < n else None
+        if n == len(tops):
+            tops.append(j)
+            top_pairs.append(k)
+        else:
+            tops[n] = j
+            top_pairs[n] = k
+    anchors = []
+    k = top_pairs[-1] if top_pairs else None
+    while k is not None:
+        anchors.append(pairs[k])
+        k = back[k]
+    anchors.reverse()
+    return anchors
+
+
+"""
+changed_a[i + 1] is set when a[i] is deleted, changed_b[j + 1] when b[j] is
+inserted.  both ends of changed_a/changed_b stay 0, so they are indexed
+like the sentinel-wrapped lists.
+"""
+def compare_sequences(a, b, deadline=None):
+    changed_a = bytearray(len(a) + 2)
+    changed_b = bytearray(len(b) + 2)
+
+    ## identical leading and trailing lines never take part
+    lo = 0
+    while lo < len(a) and lo < len(b) and a[lo] == b[lo]:
+        lo += 1
+    (a_hi, b_hi) = (len(a), len(b))
+    while lo < a_hi and lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+        a_hi -= 1
+        b_hi -= 1
+
+    (undiscarded_a, real_a) = discard_confusing_lines(a, lo, a_hi, b, lo, b_hi, changed_a)
+    (undiscarded_b, real_b) = discard_confusing_lines(b, lo, b_hi, a, lo, a_hi, changed_b)
+
+    size = len(undiscarded_a) + len(undiscarded_b) + 3
+    v = (len(undiscarded_b) + 1, [0] * size, [0] * size)    ## (diagonal offset, forward, backward)
+    (deleted, inserted) = ([], [])
+    compareseq(undiscarded_a, 0, len(undiscarded_a), undiscarded_b, 0, len(undiscarded_b), v, deleted, inserted, deadline)
+    for x in deleted:
+        changed_a[real_a[x] + 1] = 1
+    for y in inserted:
+        changed_b[real_b[y] + 1] = 1
+
+    shift_boundaries(a, changed_a, changed_b, lo, a_hi)
+    shift_boundaries(b, changed_b, changed_a, lo, b_hi)
+    return (changed_a, changed_b)
+
+
+"""
+lines of a[lo:hi] that match no line of b[other_lo:other_hi] are marked
+changed right away and left out of the comparison, and so are runs of lines
+that match too many lines of the other side.
+returns the remaining lines and their indexes in a.
+"""
+def discard_confusing_lines(a, lo, hi, b, other_lo, other_hi, changed):
+    counts = {}
+    for e in b[other_lo:other_hi]:
+        counts[e] = counts.get(e, 0) + 1
+
+    end = hi - lo
+    many = 5                ## times approximate square root of the number of lines
+    tem = end // 64 >> 2
+    while 0 < tem:
+        many *= 2
+        tem >>= 2
+
+    discards = bytearray(end)    ## 1: discard, 2: provisionally discard
+    for i in range(end):
+        nmatch = counts.get(a[lo + i], 0)
+        if nmatch == 0:
+            discards[i] = 1
+        elif many < nmatch:
+            discards[i] = 2
+
+    ## provisional discards stand only in the middle of a run of discards
+    i = 0
+    while i < end:
+        if discards[i] == 2:
+            discards[i] = 0
+        elif discards[i] != 0:
+            provisional = 0
+            j = i
+            while j < end and discards[j] != 0:
+                if discards[j] == 2:
+                    provisional += 1
+                j += 1
+            while i < j and discards[j - 1] == 2:
+                j -= 1
+                discards[j] = 0
+                provisional -= 1
+            length = j - i
+
+            if length < provisional * 4:
+                for k in range(i, j):
+                    if discards[k] == 2:
+                        discards[k] = 0
+            else:
+                minimum = 1
+                tem = length >> 4
+                while 0 < tem:
+                    minimum <<= 1
+                    tem >>= 2
+                minimum += 1
+
+                ## cancel subruns of `minimum` or more provisionals
+                j = 0
+                consec = 0
+                while j < length:
+                    if discards[i + j] != 2:
+                        consec = 0
+                    else:
+                        consec += 1
+                        if consec == minimum:
+                            j -= consec
+                        elif minimum < consec:
+                            discards[i + j] = 0
+                    j += 1
+
+                ## cancel provisionals at both ends of the run, up to 3
+                ## nonprovisionals in a row or the first one 8 lines in
+                for (first, step) in ((i, 1), (i + length - 1, -1)):
+                    consec = 0
+                    for j in range(length):
+                        k = first + step * j
+                        if 8 <= j and discards[k] == 1:
+                            break
+                        if discards[k] == 2:
+                            consec = 0
+                            discards[k] = 0
+                        elif discards[k] == 0:
+                            consec = 0
+                        else:
+                            consec += 1
+                        if consec == 3:
+                            break
+                i += length - 1
+        i += 1
+
+    undiscarded = []
+    real = []
+    for i in range(end):
+        if discards[i] == 0:
+            undiscarded.append(a[lo + i])
+            real.append(lo + i)
+        else:
+            changed[lo + i + 1] = 1
+    return (undiscarded, real)
+
+
+def compareseq(a, x_lo, x_hi, b, y_lo, y_hi, v, deleted, inserted, deadline=None):
+    while x_lo < x_hi and y_lo < y_hi and a[x_lo] == b[y_lo]:
+        x_lo += 1
+        y_lo += 1
+    while x_lo < x_hi and y_lo < y_hi and a[x_hi - 1] == b[y_hi - 1]:
+        x_hi -= 1
+        y_hi -= 1
+
+    if x_lo == x_hi:
+        inserted += range(y_lo, y_hi)
+    elif y_lo == y_hi:
+        deleted += range(x_lo, x_hi)
+    else:
+        (x_mid, y_mid) = diag(a, x_lo, x_hi, b, y_lo, y_hi, v, deadline)
+        compareseq(a, x_lo, x_mid, b, y_lo, y_mid, v, deleted, inserted, deadline)
+        compareseq(a, x_mid, x_hi, b, y_mid, y_hi, v, deleted, inserted, deadline)
+
+
+"""
+find the midpoint of the shortest edit script, searching forward from the
+top-left and backward from the bottom-right corner at the same time.
+diagonal d is x - y in absolute coordinates.  the deadline is checked once
+per edit cost.
+"""
+def diag(a, x_lo, x_hi, b, y_lo, y_hi, v, deadline=None):
+    (off, fd, bd) = v
+    d_min = x_lo - y_hi
+    d_max = x_hi - y_lo
+    f_mid = x_lo - y_lo
+    b_mid = x_hi - y_hi
+    (f_min, f_max) = (f_mid, f_mid)
+    (b_min, b_max) = (b_mid, b_mid)
+    odd = (f_mid - b_mid) & 1
+    fd[off + f_mid] = x_lo
+    bd[off + b_mid] = x_hi
+    beyond = x_hi + 1
+
+    while True:
+        if deadline is not None and time.monotonic() > deadline:
+            raise OverBudget("seconds")
+        if d_min < f_min:
+            f_min -= 1
+            fd[off + f_min - 1] = -1
+        else:
+            f_min += 1
+        if f_max < d_max:
+            f_max += 1
+            fd[off + f_max + 1] = -1
+        else:
+            f_max -= 1
+        for d in range(f_max, f_min - 1, -2):
+            (t_lo, t_hi) = (fd[off + d - 1], fd[off + d + 1])
+            x = t_hi if t_lo < t_hi else t_lo + 1
+            y = x - d
+            while x < x_hi and y < y_hi and a[x] == b[y]:
+                x += 1
+                y += 1
+            fd[off + d] = x
+            if odd and b_min <= d <= b_max and bd[off + d] <= x:
+                return (x, y)
+
+        if d_min < b_min:
+            b_min -= 1
+            bd[off + b_min - 1] = beyond
+        else:
+            b_min += 1
+        if b_max < d_max:
+            b_max += 1
+            bd[off + b_max + 1] = beyond
+        else:
+            b_max -= 1
+        for d in range(b_max, b_min - 1, -2):
+            (t_lo, t_hi) = (bd[off + d - 1], bd[off + d + 1])
+            x = t_lo if t_lo < t_hi else t_hi - 1
+            y = x - d
+            while x_lo < x and y_lo < y and a[x - 1] == b[y - 1]:
+                x -= 1
+                y -= 1
+            bd[off + d] = x
+            if not odd and f_min <= d <= f_max and x <= fd[off + d]:
+                return (x, y)
+
+
+"""
+slide each run of changes in a[lo:hi] up and down over equal lines so that
+runs merge where they can, and otherwise line up with a run of changes in
+the other file (or end as late as possible).
+"""
+def shift_boundaries(a, changed, other_changed, lo, hi):
+    ## changed[i + 1] is for a[i]
+    i = lo
+    j = lo
+    while True:
+        while i < hi and not changed[i + 1]:
+            while other_changed[j + 1]:
+                j += 1
+            j += 1
+            i += 1
+        if i == hi:
+            break
+
+        start = i
+        i += 1
+        while changed[i + 1]:
+            i += 1
+        while other_changed[j + 1]:
+            j += 1
+
+        while True:
+            runlength = i - start
+
+            while lo < start and a[start - 1] == a[i - 1]:
+                start -= 1
+                changed[start + 1] = 1
+                i -= 1
+                changed[i + 1] = 0
+                while changed[start]:
+                    start -= 1
+                j -= 1
+                while other_changed[j + 1]:
+                    j -= 1
+
+            corresponding = i if other_changed[j] else hi
+
+            while i != hi and a[start] == a[i]:
+                changed[start + 1] = 0
+                start += 1
+                changed[i + 1] = 1
+                i += 1
+                while changed[i + 1]:
+                    i += 1
+                j += 1
+                while other_changed[j + 1]:
+                    j += 1
+                    corresponding = i
+
+            if runlength == i - start:
+                break
+
+        while corresponding < i:
+            start -= 1
+            changed[start + 1] = 1
+            i -= 1
+            changed[i + 1] = 0
+            j -= 1
+            while other_changed[j + 1]:
+                j -= 1
+
+
+"""
+the changelist of the changed flags of two sentinel-wrapped line lists.
+changed_a[i] is for lines_a[a_lo + i] and changed_b[j] for lines_b[b_lo + j],
+so that the flags of a window of the lines give entries numbered as in the
+whole lists.
+"""
+def changed_to_changelist(changed_a, changed_b, lines_a, lines_b, a_lo=0, b_lo=0):
+    r = []
+    (i, j) = (0, 0)
+    (n, m) = (len(changed_a), len(changed_b))
+    while i < n or j < m:
+        (a_start, b_start) = (i, j)
+        if not changed_a[i] and not changed_b[j]:
+            while i < n and j < m and not changed_a[i] and not changed_b[j]:
+                i += 1
+                j += 1
+            r.append(Unchanged(None, a_lo + a_start, a_lo + i, lines_a[a_lo + a_start:a_lo + i], b_lo + b_start, b_lo + j, lines_b[b_lo + b_start:b_lo + j]))
+            continue
+        while i < n and changed_a[i]:
+            i += 1
+        while j < m and changed_b[j]:
+            j += 1
+        (a_start, i, b_start, j) = (a_lo + a_start, a_lo + i, b_lo + b_start, b_lo + j)
+        if a_start < i and b_start < j:
+            command = b"d%d %d\n" % (a_start, i - a_start) + b"a%d %d\n" % (i - 1, j - b_start)
+            r.append(Changed(command, a_start, i, lines_a[a_start:i], b_start, j, lines_b[b_start:j]))
+        elif a_start < i:
+            command = b"d%d %d\n" % (a_start, i - a_start)
+            r.append(Deleted(command, a_start, i, lines_a[a_start:i], b_start, j, []))
+        else:
+            command = b"a%d %d\n" % (a_start - 1, j - b_start)
+            r.append(Added(command, a_start, i, [], b_start, j, lines_b[b_start:j]))
+        (i, j) = (i - a_lo, j - b_lo)
+    return r
+
+
+class OverBudget(Exception):
+    pass
+
+
+"""
+the token and time budgets of the token diffs of one file, HUNK_TOKENS,
+HUNK_SECONDS, FILE_TOKENS and FILE_SECONDS unless given (0 for none).
+tokens are the sensible tokens of both sides of a hunk; the file's tokens
+are those of the hunks that were token diffed.  the seconds of the file
+run from when the Budget is made.  fallbacks and timeouts count the hunks
+that fell back, and those of them that ran out of time.
+"""
+class Budget:
+    def __init__(self, hunk_tokens=None, hunk_seconds=None, file_tokens=None, file_seconds=None):
+        self.hunk_tokens = HUNK_TOKENS if hunk_tokens is None else hunk_tokens
+        self.hunk_seconds = HUNK_SECONDS if hunk_seconds is None else hunk_seconds
+        self.file_tokens = FILE_TOKENS if file_tokens is None else file_tokens
+        self.file_seconds = FILE_SECONDS if file_seconds is None else file_seconds
+        self.start = time.monotonic()
+        self.tokens = 0
+        self.fallbacks = 0
+        self.timeouts = 0
+
+    def check(self, n):
+        if 0 < self.hunk_tokens < n or 0 < self.file_tokens < self.tokens + n:
+            raise OverBudget("tokens")
+
+    def charged(self, result, n):
+        self.check(n)
+        self.tokens += n
+        return result
+
+    def deadline(self):
+        deadlines = []
+        if self.hunk_seconds > 0:
+            deadlines.append(time.monotonic() + self.hunk_seconds)
+        if self.file_seconds > 0:
+            deadlines.append(self.start + self.file_seconds)
+        return min(deadlines) if deadlines else None
+
+    """
+    the limits and start of this budget, with nothing spent, for a pool
+    worker.  time.monotonic() is system wide, so the deadlines still hold.
+    """
+    def copy(self):
+        budget = Budget(self.hunk_tokens, self.hunk_seconds, self.file_tokens, self.file_seconds)
+        budget.start = self.start
+        return budget
+
+    def fell_back(self, reason):
+        self.fallbacks += 1
+        wstats.count("fallback_hunks")
+        wstats.count("fallback_" + reason)
+        if reason == "seconds":
+            self.timeouts += 1
+
+
+"""
+the token diff of a Changed entry, as (a_midway, b_midway) lists of chunks.
+with a budget, OverBudget is raised instead when the hunk has more tokens
+than it allows, or the diff runs past its deadline.
+"""
+def changed(c, token_diff=None, verify=None, tokenizer=None, budget=None):
+    assert c.__class__ == Changed
+    (diff_command, a_start, a_end, a_lines, b_start, b_end, b_lines) = c
+
+    with wstats.timer("tokenize"):
+        a_tokens = token_bounds(b''.join(a_lines), tokenizer)
+        b_tokens = token_bounds(b''.join(b_lines), tokenizer)
+        a_sensible = sensible_indexes(a_tokens)
+        b_sensible = sensible_indexes(b_tokens)
+    wstats.count("changed_hunks")
+    wstats.count("tokens", len(a_tokens.bounds) + len(b_tokens.bounds) - 2)
+    n_tokens = len(a_sensible) + len(b_sensible)
+    deadline = None
+    if budget is not None:
+        budget.check(n_tokens)
+        deadline = budget.deadline()
+    a_list = token_list(a_tokens, a_sensible)
+    b_list = token_list(b_tokens, b_sensible)
+
+    ## white space changes only: the midway text is b's
+    if a_list == b_list:
+        wstats.count("whitespace_hunks")
+        if budget is not None:
+            budget.tokens += n_tokens
+        b_midway = [memoryview(b_tokens.buf)] if b_tokens.buf else []
+        return (b_midway, b_midway)
+
+    if (token_diff or TOKEN_DIFF) == "diff":
+        try:
+            file_a = write_tokens_to_tempfile(a_list, end=b"\n")
+            file_b = write_tokens_to_tempfile(b_list, end=b"\n")
+            (r, lines_a, lines_b, raw_a, raw_b) = diff_n(file_a, file_b, verify=verify, deadline=deadline, check=None, line_diff="diff")
+        finally:
+            os.unlink(file_a)
+            os.unlink(file_b)
+    else:
+        ## sentinels are never compared by diff_sequences()
+        lines_a = [b"^"] + a_list + [b"$"]
+        lines_b = [b"^"] + b_list + [b"$"]
+        anchored = 0 < ANCHOR_MIN <= len(lines_a) + len(lines_b) - 4
+        with wstats.timer("token_diff"):
+            r = diff_sequences(lines_a, lines_b, anchored=anchored, deadline=deadline)
+    if budget is not None:
+        budget.tokens += n_tokens
+
+    ## the sentinels always match
+    assert r[0].__class__ == Unchanged and r[-1].__class__ == Unchanged
 
     del diff_command, a_start, a_end, a_lines, b_start, b_end, b_lines # foolproof
 
-    a_end = 0
-    b_end = 0
+    ## positions are sentinel-wrapped:
+    ##   sensible j : 0 is '^', 1..len(sensible) are the sensible tokens, then '$'
+    ##   raw k      : 0 is '^', 1..n are the tokens, n + 1 is '$'
+    ## raw_end() is the end of the run of raw tokens that covers the sensible
+    ## tokens before j.  the output is a slice of the hunk per changelist entry.
+    def raw_end(sensible, n_raw, j):
+        j -= 1
+        if j == 0:
+            raw_index = 0
+        elif j <= len(sensible):
+            raw_index = sensible[j - 1]
+        else:
+            raw_index = n_raw
+        return raw_index + 2
+
+    def raw_bytes(tokens, raw_start, raw_end):
+        (buf, bounds, blank) = tokens
+        def offset(k):      ## the sentinels are empty
+            return bounds[min(max(k, 1), len(bounds)) - 1]
+        return memoryview(buf)[offset(raw_start):offset(max(raw_start, raw_end))]
+
+    prev_a_start = 0
+    prev_b_start = 0
 
     a_out = []
     b_out = []
     raw_a_end = 0
     raw_b_end = 0
+    n_a = len(a_tokens.bounds) - 1
+    n_b = len(b_tokens.bounds) - 1
 
     for e in r:
-        #syslog(LOG_DEBUG, f"@@@ @@@ @@@ E: {e.__class__.__name__}")
-        #syslog(LOG_DEBUG, f"@@@ @@@ @@@ E: a_end={a_end}")
-        #syslog(LOG_DEBUG, f"@@@ @@@ @@@ E: b_end={b_end}")
-        #syslog(LOG_DEBUG, f"@@@ @@@ @@@ E: e.a_start={e.a_start} e.a_end={e.a_end}")
-        #syslog(LOG_DEBUG, f"@@@ @@@ @@@ E: e.a_lines={e.a_lines}")
-        #syslog(LOG_DEBUG, f"@@@ @@@ @@@ E: e.b_start={e.b_start} e.b_end={e.b_end}")
-        #syslog(LOG_DEBUG, f"@@@ @@@ @@@ E: e.b_lines={e.b_lines}")
-
-
         if e.__class__ == Changed:
-            #syslog(LOG_DEBUG, f"@@@ C: TOKEN CHANGED {e.a_start}--{e.a_end} => {e.b_start}--{e.b_end}")
-            a = a_sensible_ws[e.a_start:e.a_end]
-            b = b_sensible_ws[e.b_start:e.b_end]
-
             raw_a_start = raw_a_end
-            raw_a_end = a[-1].raw_index + 2
-            #syslog(LOG_DEBUG, f"@@@ C: RAW INDEX A {raw_a_start} {raw_a_end}")
-            x = a_raw_tokens_ws[raw_a_start:raw_a_end]
-            #syslog(LOG_DEBUG, f"@@@ C: A_LINES             a={e.a_lines}")
-            #syslog(LOG_DEBUG, f"@@@ C: A                   a={a}")
-            #syslog(LOG_DEBUG, f"@@@ C: RAW TOKEN CHANGED - x={x}")
-            x_tokens = [token for (token, start, end) in x]
-            a_end = e.a_end
-            #syslog(LOG_DEBUG, f"@@@ C: a_out += {x}")
-            a_out += x_tokens
+            raw_a_end = raw_end(a_sensible, n_a, e.a_end)
+            a_out.append(raw_bytes(a_tokens, raw_a_start, raw_a_end))
 
             raw_b_start = raw_b_end
-            raw_b_end = b[-1].raw_index + 2
-            #syslog(LOG_DEBUG, f"@@@ C: RAW INDEX B {raw_b_start} {raw_b_end}")
-            x = b_raw_tokens_ws[raw_b_start:raw_b_end]
-            #syslog(LOG_DEBUG, f"@@@ C: B_LINES             b={e.b_lines}")
-            #syslog(LOG_DEBUG, f"@@@ C: B                   b={b}")
-            #syslog(LOG_DEBUG, f"@@@ C: RAW TOKEN CHANGED + x={x}")
-            x_tokens = [token for (token, start, end) in x]
-            b_end = e.b_end
-            b_out += x_tokens
+            raw_b_end = raw_end(b_sensible, n_b, e.b_end)
+            b_out.append(raw_bytes(b_tokens, raw_b_start, raw_b_end))
 
         elif e.__class__ == Added:
-            #syslog(LOG_DEBUG, f"@@@ A: TOKEN ADDED {e.a_start} => {e.b_start}--{e.b_end}")
             assert e.a_start == e.a_end
-            b = b_sensible_ws[e.b_start:e.b_end]
             raw_b_start = raw_b_end
-            raw_b_end = b[-1].raw_index + 2
-            #syslog(LOG_DEBUG, f"@@@ A: RAW INDEX B {raw_b_start} {raw_b_end}")
-            #syslog(LOG_DEBUG, f"@@@ A: TOKEN ADDED b={b}")
-            x = b_raw_tokens_ws[raw_b_start:raw_b_end]
-            #syslog(LOG_DEBUG, f"@@@ A: RAW TOKEN ADDED x={x}")
-            x_tokens = [token for (token, start, end) in x]
-            b_end += e.b_end
-            b_out += x_tokens
+            raw_b_end = raw_end(b_sensible, n_b, e.b_end)
+            b_out.append(raw_bytes(b_tokens, raw_b_start, raw_b_end))
 
         elif e.__class__ == Unchanged:
-            #syslog(LOG_DEBUG, f"@@@ U: TOKEN UNCHANGED {e.a_start}--{e.a_end} => {e.b_start}--{e.b_end}")
             assert e.a_end - e.a_start == e.b_end - e.b_start
-            a = a_sensible_ws[e.a_start:e.a_end]
-            b = b_sensible_ws[e.b_start:e.b_end]
-            raw_a_start = raw_a_end
-            raw_a_end = a[-1].raw_index + 2
+            assert not verifying(verify) or all(compare_list(e.a_lines, e.b_lines))
+            raw_a_end = raw_end(a_sensible, n_a, e.a_end)
             raw_b_start = raw_b_end
-            raw_b_end = b[-1].raw_index + 2
-            #syslog(LOG_DEBUG, f"@@@ U: RAW INDEX B {raw_b_start} {raw_b_end}")
-            #syslog(LOG_DEBUG, f"@@@ U: TOKEN UNCHANGED a={a}")
-            #syslog(LOG_DEBUG, f"@@@ U: TOKEN UNCHANGED b={b}")
-            assert all(compare_list([e for (i, e, start, end) in a], [e for (i, e, start, end) in b]))
-            x = b_raw_tokens_ws[raw_b_start:raw_b_end]
-            #syslog(LOG_DEBUG, f"@@@ U: RAW TOKEN UNCHANGED x={x}")
-            x_tokens = [token for (token, start, end) in x]
-            a_end = e.a_end
-            b_end = e.b_end
-            #syslog(LOG_DEBUG, f"@@@ U: a_out += {x}")
-            a_out += x_tokens  ## b_raw_tokensをa_outに追加する。対応するa_raw_tokensは捨てる。
-            b_out += x_tokens
+            raw_b_end = raw_end(b_sensible, n_b, e.b_end)
+            x = raw_bytes(b_tokens, raw_b_start, raw_b_end)
+            a_out.append(x)  ## b_raw_tokensをa_outに追加する。対応するa_raw_tokensは捨てる。
+            b_out.append(x)
 
         elif e.__class__ == Deleted:
-            #syslog(LOG_DEBUG, f"@@@ D: TOKEN DELETED {e.a_start}--{e.a_end}, b={e.b_start}")
             assert e.b_start == e.b_end
-            a = a_sensible_ws[e.a_start:e.a_end]
             raw_a_start = raw_a_end
-            raw_a_end = a[-1].raw_index + 2
-            #syslog(LOG_DEBUG, f"@@@ D: RAW INDEX A {raw_a_start} {raw_a_end}")
-            #syslog(LOG_DEBUG, f"@@@ D: TOKEN DELETED a={a}")
-            x = a_raw_tokens_ws[raw_a_start:raw_a_end]
-            #syslog(LOG_DEBUG, f"@@@ D: RAW TOKEN DELETED x={x}")
-            x_tokens = [token for (token, start, end) in x]
-            x_tokens = [token for (token, start, end) in x]
-            a_end = e.a_end
-            #syslog(LOG_DEBUG, f"@@@ D: a_out += {x}")
-            a_out += x_tokens
+            raw_a_end = raw_end(a_sensible, n_a, e.a_end)
+            a_out.append(raw_bytes(a_tokens, raw_a_start, raw_a_end))
 
         else:
             raise Exception("Internal Error")
@@ -395,42 +1955,191 @@ def changed(c):
         prev_b_start = e.b_end
 
     # COPY TRAILING INTRON
-    raw_b_start = raw_b_end
-    raw_b_end = len(b_raw_tokens_ws)
-    #syslog(LOG_DEBUG, f"@@@ T: RAW INDEX B {raw_b_start} {raw_b_end}")
-    x = b_raw_tokens_ws[raw_b_start:]
-    #syslog(LOG_DEBUG, f"@@@ T: RAW TRAILING INTRON x={x}")
-    x_tokens = [token for (token, start, end) in x]
-    #syslog(LOG_DEBUG, f"@@@ I: a_out += {x}")
-    a_out += x_tokens
-    b_out += x_tokens
+    x = raw_bytes(b_tokens, raw_b_end, n_b + 2)
+    a_out.append(x)
+    b_out.append(x)
 
     assert prev_a_start == len(lines_a)
     assert prev_b_start == len(lines_b)
 
-    def strip_sentinel(raw_ws):
-        assert raw_ws[0] == b'^'
-        assert raw_ws[-1] == b'$'
-        return raw_ws[1:][:-1]
+    a_midway = [x for x in a_out if len(x) > 0]
+    b_midway = [x for x in b_out if len(x) > 0]
 
-    #syslog(LOG_DEBUG, f"@@@ A_OUT {a_out}")
-    #syslog(LOG_DEBUG, f"@@@ B_OUT {b_out}")
+    if verifying(verify):
+        assert b''.join(b_midway) == b_tokens.buf
+    else:
+        assert sum(len(x) for x in b_midway) == len(b_tokens.buf)
 
-    #syslog(LOG_DEBUG, f"@@@ A_OUT_WO_S {strip_sentinel(a_out)}")
-    #syslog(LOG_DEBUG, f"@@@ B_OUT_WO_S {strip_sentinel(b_out)}")
+    return (a_midway, b_midway)
 
-    a_midway = strip_sentinel(a_out)
-    b_midway = strip_sentinel(b_out)
 
-    #syslog(LOG_DEBUG, f"@@@ MIDWAY: {b_midway}")
-    #syslog(LOG_DEBUG, f"@@@ EXPECT: {strip_sentinel([e for (e, start, end) in b_raw_tokens_ws])}")
-    assert all(compare_list(b_midway, strip_sentinel([e for (e, start, end) in b_raw_tokens_ws])))
+"""
+changed() of the Changed entries of r, in order.  with more than one job
+the large hunks go to a pool up front and the small ones run inline while
+the pool works; each result is joined to one bytes, so the output is the
+same as from the serial path.
+
+a hunk over the budget (a new Budget() when None) gets its lines as they
+are instead: the midway text is a's text, so the hunk reads as a plain
+diff.  the file's token budget is charged in hunk order, also for the
+hunks of the pool, so which hunks fall back does not depend on the jobs.
+"""
+def changed_hunks(r, token_diff=None, jobs=None, verify=None, tokenizer=None, budget=None):
+    jobs = JOBS if jobs is None else jobs
+    budget = Budget() if budget is None else budget
+    hunks = [e for e in r if e.__class__ == Changed]
+    keys = [memo_key(e, token_diff, tokenizer) for e in hunks]
+    memoized = [memo_get(key) for key in keys]
+    large = [a_mid is None and hunk_size(e) >= PARALLEL_MIN for (e, a_mid) in zip(hunks, memoized)]
+    if jobs <= 1 or sum(large) < 2:
+        for (e, key, a_mid) in zip(hunks, keys, memoized):
+            if a_mid is not None:
+                yield budgeted_hunk(e, None, budget, lambda: memo_hit(e, a_mid, budget, tokenizer))
+            else:
+                yield budgeted_hunk(e, key, budget, lambda: changed(e, token_diff=token_diff, verify=verify, tokenizer=tokenizer, budget=budget))
+        return
+
+    import multiprocessing      ## only here: most runs never start a pool
+    import multiprocessing.pool
+    pool_kind = POOL
+    if pool_kind == "process" and multiprocessing.current_process().daemon:
+        pool_kind = "thread"    ## daemonic workers (wbatch.py) cannot have children
+    if pool_kind == "process":
+        pool = multiprocessing.Pool(min(jobs, sum(large)))
+    else:
+        pool = multiprocessing.pool.ThreadPool(min(jobs, sum(large)))
+    with pool:
+        pending = [pool.apply_async(changed_joined, (joined_hunk(e), token_diff, verify, tokenizer, budget.copy())) if is_large else None for (e, is_large) in zip(hunks, large)]
+        for (e, key, a_mid, result) in zip(hunks, keys, memoized, pending):
+            if a_mid is not None:
+                yield budgeted_hunk(e, None, budget, lambda: memo_hit(e, a_mid, budget, tokenizer))
+            elif result is None:
+                yield budgeted_hunk(e, key, budget, lambda: changed(e, token_diff=token_diff, verify=verify, tokenizer=tokenizer, budget=budget))
+            else:
+                yield budgeted_hunk(e, key, budget, lambda: budget.charged(*result.get()))
+
+
+"""
+run() memoized under key, or the lines of c as they are when it goes over
+budget.  fallbacks are not memoized: a later run may have more budget.
+"""
+def budgeted_hunk(c, key, budget, run):
+    try:
+        return memo_put(key, run())
+    except OverBudget as e:
+        budget.fell_back(e.args[0])
+        return ([b"".join(c.a_lines)], [b"".join(c.b_lines)])
+
+
+"""
+memo key of a Changed entry: the tokenizer and the token diff settings
+that shape the alignment and the hashes of both sides, or None with the memo off.
+"""
+def memo_key(c, token_diff=None, tokenizer=None):
+    if MEMO_SIZE <= 0 and not MEMO_DISK:
+        return None
+    return (f"hunk-{(tokenizer or c_tokenizer).name}-{token_diff or TOKEN_DIFF}-{ANCHOR_MIN}", hashlib.sha1(b"".join(c.a_lines)).hexdigest(), hashlib.sha1(b"".join(c.b_lines)).hexdigest())
 
-    return (a_midway, b_midway)
 
+"""
+the midway text of the hunk of `key`, or None.
+"""
+def memo_get(key):
+    if key is None:
+        return None
+    with memo_lock:
+        a_mid = memo.get(key)
+        if a_mid is not None:
+            memo.move_to_end(key)
+            memo_count("hits")
+            return a_mid
+    if MEMO_DISK:
+        disk_key = wcache.key(*key)
+        a_mid = wcache.get(disk_key) if disk_key else None
+        if a_mid is not None:
+            memo_count("disk_hits")
+            memo_store(key, a_mid)
+            return a_mid
+    memo_count("misses")
+    return None
+
+
+"""
+stores what changed() returned for the hunk of `key`, and returns it.
+"""
+def memo_put(key, result):
+    if key is None:
+        return result
+    a_mid = b"".join(result[0])
+    memo_store(key, a_mid)
+    if MEMO_DISK:
+        disk_key = wcache.key(*key)
+        if disk_key:
+            wcache.put(disk_key, a_mid)
+    return result
+
+
+def memo_store(key, a_mid):
+    if len(a_mid) > MEMO_SIZE:
+        return
+    with memo_lock:
+        if key in memo:
+            return
+        memo[key] = a_mid
+        memo_counts["bytes"] += len(a_mid)
+        while memo_counts["bytes"] > MEMO_SIZE:
+            (_, old) = memo.popitem(last=False)
+            memo_counts["bytes"] -= len(old)
+
+
+def memo_count(name):
+    memo_counts[name] += 1
+    wstats.count("memo_" + name)
+
+
+"""
+memo_result() charged to the budget, so that which hunks fall back does not
+depend on what is memoized.
+"""
+def memo_hit(c, a_mid, budget, tokenizer=None):
+    if budget.hunk_tokens > 0 or budget.file_tokens > 0:
+        budget.charged(None, hunk_tokens(c, tokenizer))
+    return memo_result(c, a_mid)
+
+
+"""
+the sensible tokens of both sides of c, as changed() counts them.
+"""
+def hunk_tokens(c, tokenizer=None):
+    return sum(len(sensible_indexes(token_bounds(b"".join(lines), tokenizer))) for lines in (c.a_lines, c.b_lines))
+
+
+"""
+what changed() returns for c, from the memoized midway text.
+"""
+def memo_result(c, a_mid):
+    return ([a_mid] if a_mid else [], [b"".join(c.b_lines)])
 
-def flatten_list(a):
-    return [e for li in a for e in li]
+
+def hunk_size(c):
+    return sum(len(x) for x in c.a_lines) + sum(len(x) for x in c.b_lines)
+
+
+"""
+c with a_lines and b_lines as one bytes each: cheap to pickle, and
+changed() only joins them anyway.
+"""
+def joined_hunk(c):
+    return c._replace(a_lines=[b"".join(c.a_lines)], b_lines=[b"".join(c.b_lines)])
+
+
+"""
+changed() on a pool worker.  budget is the worker's own copy; the tokens it
+spent are returned along with the result, for the parent's budget.
+"""
+def changed_joined(c, token_diff=None, verify=None, tokenizer=None, budget=None):
+    (a_midway, b_midway) = changed(c, token_diff=token_diff, verify=verify, tokenizer=tokenizer, budget=budget)
+    return (([b"".join(a_midway)], [b"".join(b_midway)]), budget.tokens)
 
 
 def write_tokens_to_tempfile(tokens, end=None):
@@ -440,13 +2149,37 @@ def write_tokens_to_tempfile(tokens, end=None):
 
 
 def write_tokens_to_file(f, tokens, end=None):
-    for token in tokens:
-        f.write(token)
-        if end:
-            f.write(end)
+    if end:
+        tokens = chain.from_iterable(zip(tokens, repeat(end)))
+    f.writelines(tokens)
+
+
+"""
+chunks to f, WRITE_BATCH of them per writelines(), so that the "write"
+timer does not take in the work of a generator of chunks.
+"""
+def write_chunks(f, chunks):
+    chunks = iter(chunks)
+    while True:
+        batch = list(islice(chunks, WRITE_BATCH))
+        if not batch:
+            return
+        with wstats.timer("write"):
+            f.writelines(batch)
+
+"""
+indexes of the tokens that are not white space, i.e. the ones diffed.
+"""
+def sensible_indexes(tokens):
+    return array("I", compress(range(len(tokens.blank)), tokens.blank.translate(not_blank)))
+
 
-def sensible_tokens(tokens):
-    return [token for (token, start, end) in tokens if not isspaces(token)]
+not_blank = bytes([1]) + bytes(255)
+
+
+def token_list(tokens, indexes):
+    (buf, bounds, blank) = tokens
+    return [buf[bounds[i]:bounds[i + 1]] for i in indexes]
 
 
 def isspaces(token):
@@ -467,59 +2200,97 @@ def isalphanumeric(c):
             c == b'_'[0])
 
 
-def intern(name):
-    return (name, )
+"""
+a tokenizer splits a buffer into tokens that cover it without gaps, in
+bulk: the buffer is translated through `table`, a 256-byte table that maps
+each byte to the byte of its class, and each match of `pattern` in the
+classes is a token.  tokens whose classes are all b" " are blank.
+"""
+Tokenizer = namedtuple("Tokenizer", ["name", "table", "pattern"])
 
 
-ucs_first_byte = intern("UCS_1")
-ucs_following_byte = intern("UCS_2")
-punctuation = intern("PUNCTUATION")
-spaces = intern("SPACES")
-word_letter = intern("ALPHANUMERIC")
+def byte_class_table(class_of):
+    return bytes(class_of(c) for c in range(256))
 
 
-def tokenize(line):
-    r = []
-    token = []
-    def eject(i):
-        nonlocal token
-        nonlocal start
-        if token != []:
-            r.append(Token(bytes(token), start, i))
-            token = []
-            start = i
-    prev = None
-    start = 0
+"""
+C and the like: a run of white space, a run of letters, digits and '_', or
+any other byte alone; a UTF-8 character stays in one token, and stray
+continuation bytes stick to the token before them.
+"""
+def c_class(c):
+    if isspace(c):
+        return b" "[0]
+    elif isalphanumeric(c):
+        return b"a"[0]
+    elif 0x80 <= c and c < 0xc0:
+        return b")"[0]      ## UTF-8 continuation byte
+    else:
+        return b"."[0]      ## punctuation, control or UTF-8 first byte
 
-    for (i, c) in enumerate(line):
-        if isspace(c):
-            kind = spaces
-        elif isalphanumeric(c):
-            kind = word_letter
-        elif 0x80 <= c and c < 0xc0:
-            kind = ucs_following_byte
-        elif 0xc0 <= c:
-            kind = ucs_first_byte
-        else:
-            kind = punctuation
 
-        if kind == ucs_following_byte:
-            pass
-        elif kind == ucs_first_byte or kind == punctuation or kind != prev:
-            eject(i)
+c_tokenizer = Tokenizer("c", byte_class_table(c_class), re.compile(br"(?: +|a+|\.)\)*|\)+"))
 
-        prev = kind
+## tokenizer by file extension.  files without one get a plain line diff
+## from wdiff.py; ndiff.py and the library use c_tokenizer by default.
+TOKENIZERS = {}
 
-        token.append(c)
 
-    eject(i)
-    return r
+def register_tokenizer(tokenizer, extensions):
+    for e in extensions:
+        TOKENIZERS[e] = tokenizer
+
+
+def tokenizer_for(path):
+    return TOKENIZERS.get(os.path.splitext(path)[1])
+
+
+register_tokenizer(c_tokenizer, (".c", ".cc", ".h"))
+
+
+"""
+tokens of buf as a struct of arrays instead of a Token per token.
+tokens cover buf without gaps: token i is buf[bounds[i]:bounds[i + 1]], and
+blank[i] is 1 when it consists of white space only.
+"""
+Tokens = namedtuple("Tokens", ["buf", "bounds", "blank"])
+
+
+def token_bounds(buf, tokenizer=None):
+    (name, table, pattern) = tokenizer or c_tokenizer
+    classes = pattern.findall(buf.translate(table))
+    bounds = array("I", accumulate(map(len, classes), initial=0))
+    assert bounds[-1] == len(buf)
+    return Tokens(buf, bounds, bytearray(map(bytes.isspace, classes)))
+
+
+def tokenize(line, tokenizer=None):
+    (buf, bounds, blank) = token_bounds(line, tokenizer)
+    return [Token(bytes(buf[bounds[i]:bounds[i + 1]]), bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
 
 
 def compare_list(a, b):
     if len(a) != len(b):
         return [False]
-    return [e == g for (e, g) in zip(a, b)]
+    if a.__class__ == LineView:
+        return [a == b]
+    return (e == g for (e, g) in zip(a, b))    ## all() stops at the first difference
+
+
+"""
+whether to run the next check that looks at the lines, at verification
+level `verify` (VERIFY when None).  "sampled" runs every VERIFY_SAMPLE-th,
+starting with the first.
+"""
+def verifying(verify=None):
+    global verify_count
+    verify = verify or VERIFY
+    if verify == "full":
+        return True
+    if verify == "off":
+        return False
+    verify_count += 1
+    return VERIFY_SAMPLE <= 1 or verify_count % VERIFY_SAMPLE == 1
 
 
 if __name__ == "__main__":
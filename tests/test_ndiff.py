@@ -0,0 +1,505 @@
+## differential tests: the in-process diffs against GNU diff, over generated
+## pairs of C-like files, and unit tests of the parts around them.
+
+import mmap
+import random
+import subprocess
+import tracemalloc
+
+import pytest
+
+import ndiff
+import wstats
+
+WORDS = [b"int", b"x", b"y", b"count", b"buf", b"return", b"if", b"(", b")", b"{", b"}", b";", b"=", b"+", b"0", b"1", b"/* note */", b'"s"']
+PAIRS = 200
+
+
+def random_line(rng):
+    return b" ".join(rng.choice(WORDS) for _ in range(rng.randrange(1, 7)))
+
+
+"""
+a and b of a generated pair: b is a with a few lines added, deleted,
+re-spaced, edited or joined, and either may lack the last newline.
+"""
+def make_pair(seed):
+    rng = random.Random(seed)
+    a = [b"\t" * rng.randrange(3) + random_line(rng) for _ in range(rng.randrange(0, 40))]
+    b = list(a)
+    for _ in range(rng.randrange(0, 6)):
+        (op, i) = (rng.randrange(6), rng.randrange(len(b) + 1))
+        if op == 0:
+            b.insert(i, random_line(rng))
+        elif op == 5:
+            b.insert(i, b"")
+        elif i < len(b):
+            if op == 1:
+                del b[i]
+            elif op == 2:
+                b[i] = b[i].replace(b" ", b"  ", 1)
+            elif op == 3:
+                words = b[i].split(b" ")
+                words[rng.randrange(len(words))] = rng.choice(WORDS)
+                b[i] = b" ".join(words)
+            else:
+                b[i:i + 2] = [b" ".join(b[i:i + 2])]
+    (end_a, end_b) = (b"" if rng.random() < 0.2 else b"\n", b"" if rng.random() < 0.2 else b"\n")
+    return (b"\n".join(a) + end_a if a else b"", b"\n".join(b) + end_b if b else b"")
+
+
+@pytest.fixture
+def write_pair(tmp_path):
+    def write(a, b):
+        (file_a, file_b) = (tmp_path / "a.c", tmp_path / "b.c")
+        file_a.write_bytes(a)
+        file_b.write_bytes(b)
+        return (str(file_a), str(file_b))
+    return write
+
+
+def entries(r):
+    return [(e.__class__.__name__, e.a_start, e.a_end, e.b_start, e.b_end) for e in r]
+
+
+@pytest.mark.parametrize("seed", range(PAIRS))
+def test_token_diff_myers_as_diff(seed, write_pair, tmp_path):
+    (file_a, file_b) = write_pair(*make_pair(seed))
+    ndiff.ndiff(file_a, file_b, str(tmp_path / "myers"), token_diff="myers")
+    ndiff.ndiff(file_a, file_b, str(tmp_path / "diff"), token_diff="diff")
+    assert (tmp_path / "myers").read_bytes() == (tmp_path / "diff").read_bytes()
+
+
+@pytest.mark.parametrize("seed", range(PAIRS))
+def test_line_diff_myers_as_diff(seed, write_pair):
+    (file_a, file_b) = write_pair(*make_pair(seed))
+    myers = ndiff.diff_n(file_a, file_b, line_diff="myers")[0]
+    diff = ndiff.diff_n(file_a, file_b, line_diff="diff", verify="full")[0]
+    assert entries(myers) == entries(diff)
+
+
+@pytest.mark.parametrize("seed", range(PAIRS))
+def test_unified_as_diff_up(seed, write_pair, tmp_path):
+    (file_a, file_b) = write_pair(*make_pair(seed))
+    midway = str(tmp_path / "midway")
+    ndiff.ndiff(file_a, file_b, midway)
+    out = subprocess.run(["diff", "-U3", "-p", midway, file_b], stdout=subprocess.PIPE).stdout
+    assert b"".join(ndiff.ndiff_unified(file_a, file_b)) == b"".join(out.splitlines(keepends=True)[2:])
+
+
+def test_precheck(write_pair):
+    assert ndiff.precheck(*write_pair(b"int x;\n", b"int x;\n")) == "same"
+    assert ndiff.precheck(*write_pair(b"int x;\n", b"int y;\n")) is None
+    assert ndiff.precheck(*write_pair(b"\0\1", b"\0\2")) == "binary"
+    assert ndiff.precheck(*write_pair(b"\0\1", b"\0\1")) == "same"
+
+
+def test_binary_and_same_files(write_pair, tmp_path):
+    out = tmp_path / "midway"
+    (file_a, file_b) = write_pair(b"\0\1", b"\0\2")
+    ndiff.ndiff(file_a, file_b, str(out))
+    assert out.read_bytes() == b"Binary files " + file_a.encode() + b" and " + file_b.encode() + b" differ\n"
+    assert ndiff.ndiff_unified(file_a, file_b) == []
+    assert ndiff.ndiff_bytes(b"\0\1", b"\0\2") is None
+    (file_a, file_b) = write_pair(b"int x;\n", b"int x;\n")
+    ndiff.ndiff(file_a, file_b, str(out))
+    assert out.read_bytes() == b"int x;\n"
+
+
+## a NUL past the first block does not make the files binary, wherever the
+## middles left after the common ends start
+@pytest.mark.parametrize(("i", "j"), [(398, 402), (250, 590), (20, 30)])
+def test_nul_past_the_first_block(i, j, write_pair):
+    a = b"".join(b"int x%d = %d;\n" % (k, k) for k in range(600)).replace(b"x400 = 400", b'x400 = "\0"')
+    assert ndiff.BINARY_SNIFF < a.index(b"\0")
+    b = a.replace(b"x%d = %d;" % (i, i), b"x%d = 0;" % i).replace(b"x%d = %d;" % (j, j), b"x%d = 0;" % j)
+    (file_a, file_b) = write_pair(a, b)
+    diff = ndiff.diff_n(file_a, file_b, line_diff="diff", verify="full")[0]
+    assert diff is not None
+    assert entries(diff) == entries(ndiff.diff_n(file_a, file_b, line_diff="myers")[0])
+    out = b"".join(ndiff.ndiff_unified(file_a, file_b, line_diff="diff", token_diff="diff"))
+    assert b"-int x%d = %d;\n+int x%d = 0;\n" % (i, i, i) in out
+    assert b"-int x%d = %d;\n+int x%d = 0;\n" % (j, j, j) in out
+
+
+def test_is_binary():
+    assert not ndiff.is_binary(b"a\n", b"b\n")
+    assert ndiff.is_binary(b"a\0", b"b\n")
+    assert not ndiff.is_binary(b"a\0", b"a\0")
+
+
+def test_whitespace_only_file(write_pair):
+    (file_a, file_b) = write_pair(b"int x = 1;\n", b"int  x =\n  1;\n")
+    assert ndiff.whitespace_only(file_a, file_b)
+    assert ndiff.ndiff_unified(file_a, file_b) == []
+    assert ndiff.ndiff_bytes(b"int x = 1;\n", b"int  x =\n  1;\n") == ([b"int  x =\n  1;\n"], None)
+
+
+## lines of white space added and deleted around a change are b's in the
+## midway text, and only the change shows
+def test_whitespace_only_lines(write_pair, monkeypatch):
+    a = b"int x;\n\nint y;\nint z;\nint w;\n"
+    b = b"int x;\nint y;\n  \n\nint z;\nint w = 1;\n"
+    (file_a, file_b) = write_pair(a, b)
+    assert midway(ndiff.ndiff_bytes(a, b)[0]) == b.replace(b"w = 1", b"w")
+    assert b"".join(ndiff.ndiff_unified(file_a, file_b, context=0)) == b"@@ -6 +6 @@ int z;\n-int w;\n+int w = 1;\n"
+    monkeypatch.setattr(ndiff, "WHITESPACE_CHECK", False)
+    assert midway(ndiff.ndiff_bytes(a, b)[0]) == a
+
+
+@pytest.mark.parametrize(("a", "b", "head", "tail"), [
+    (b"x\ny\nz\n", b"x\nq\nz\n", 1, 1),
+    (b"x\ny", b"x\nz", 1, 0),
+    (b"d\nb", b"", 0, 0),
+    (b"x\ny", b"y", 0, 1),
+    (b"x\n", b"x\nx\n", 1, 0),
+])
+def test_common_ends(a, b, head, tail):
+    (lines_a, lines_b) = (ndiff.buffer_lines(a), ndiff.buffer_lines(b))
+    assert ndiff.common_ends(a, lines_a, b, lines_b)[:2] == (head, tail)
+
+
+def git_patch(file_a, file_b, context=0):
+    return subprocess.run(["git", "diff", "--no-index", f"-U{context}", file_a, file_b], stdout=subprocess.PIPE).stdout
+
+
+@pytest.mark.parametrize("context", [0, 3])
+def test_patch_to_changelist(context, write_pair):
+    a = b"".join(b"line %d\n" % i for i in range(20))
+    b = a.replace(b"line 3\n", b"").replace(b"line 10\n", b"line ten\nline 10.5\n") + b"line 20"
+    (file_a, file_b) = write_pair(a, b)
+    from_patch = ndiff.diff_n(file_a, file_b, patch=git_patch(file_a, file_b, context), verify="full")[0]
+    assert entries(from_patch) == entries(ndiff.diff_n(file_a, file_b, line_diff="diff")[0])
+
+
+def test_patch_to_changelist_mismatch(write_pair):
+    (file_a, file_b) = write_pair(b"a\nb\n", b"a\nc\n")
+    patch = git_patch(file_a, file_b)
+    (file_a, file_b) = write_pair(b"a\nx\n", b"a\nc\n")
+    with pytest.raises(Exception):
+        ndiff.diff_n(file_a, file_b, patch=patch, verify="full")
+
+
+def test_patch_to_changelist_binary():
+    lines = ndiff.buffer_lines(b"a\n")
+    assert ndiff.patch_to_changelist(b"Binary files a/x and b/x differ\n", lines, lines) is None
+
+
+## `diff -n` output that adds "w" where b has "z": the unchanged line before
+## it is the first check, the added line the second.  "sampled" runs the
+## first of every VERIFY_SAMPLE checks.
+@pytest.mark.parametrize("verify, count, detected", [
+    ("full", 0, True),
+    ("off", ndiff.VERIFY_SAMPLE - 1, False),
+    ("sampled", 0, False),
+    ("sampled", ndiff.VERIFY_SAMPLE - 1, True),
+])
+def test_verify_levels(verify, count, detected, monkeypatch):
+    (a, b) = (b"x\n", b"x\nz\n")
+    (lines_a, lines_b) = (ndiff.buffer_lines(a), ndiff.buffer_lines(b))
+    monkeypatch.setattr(ndiff, "verify_count", count)
+    if detected:
+        with pytest.raises(AssertionError):
+            ndiff.rcs_format_to_changelist(b"a1 1\nw\n", lines_a, lines_b, a, b, verify=verify)
+    else:
+        r = ndiff.rcs_format_to_changelist(b"a1 1\nw\n", lines_a, lines_b, a, b, verify=verify)
+        assert r[1].b_lines == [b"w\n"]
+
+
+def midway(chunks):
+    return None if chunks is None else b"".join(chunks)
+
+
+"""
+random edits of b, one line at a time.
+"""
+def edits(b, seed, n=50):
+    rng = random.Random(seed)
+    for k in range(n):
+        lines = b.splitlines(keepends=True)
+        i = rng.randrange(len(lines) + 1)
+        if rng.randrange(2):
+            lines[i:i] = [b"int v%d = %d;\n" % (k, rng.randrange(100))]
+        elif rng.randrange(2):
+            lines[i:i + 1] = [e.replace(b"1", b"2") for e in lines[i:i + 1]]
+        else:
+            del lines[i:i + 1]
+        b = b"".join(lines)
+        yield b
+
+
+## with distinct lines there is one alignment, so the pieces line up as the
+## whole files do
+def test_session_as_ndiff_bytes():
+    a = b"".join(b"int x%d = %d;\n" % (i, i % 7) for i in range(100))
+    session = ndiff.Session(a, verify="full")
+    for b in edits(a, 1):
+        assert midway(session.update(b)) == midway(ndiff.ndiff_bytes(a, b)[0])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_session_changelist(seed):
+    (a, b) = make_pair(seed)
+    session = ndiff.Session(a, verify="full")
+    assert midway(session.update(b)) == midway(ndiff.ndiff_bytes(a, b)[0])
+    for b in edits(b, seed, 10):
+        session.update(b)
+        assert b"".join(line for e in session.r for line in e.a_lines) == b"^\n" + a + b"$\n"
+        assert b"".join(line for e in session.r for line in e.b_lines) == b"^\n" + b + b"$\n"
+        for e in session.r:
+            if e.__class__ == ndiff.Unchanged:
+                assert list(e.a_lines) == list(e.b_lines)
+
+
+def test_session_edit():
+    a = b"int x = 1;\nint y = 2;\n"
+    session = ndiff.Session(a)
+    session.update(a)
+    assert midway(session.edit(4, 5, b"z")) == midway(ndiff.ndiff_bytes(a, b"int z = 1;\nint y = 2;\n")[0])
+    assert session.raw_b == b"int z = 1;\nint y = 2;\n"
+
+
+def test_session_buffers():
+    (a, b) = (b"int x;\nint y;\n", b"int x;\n\nint  y;\n")
+    session = ndiff.Session(bytearray(a))
+    assert midway(session.update(memoryview(b))) == b
+    assert midway(session.update(bytearray(b"int x;\nint z;\n"))) == midway(ndiff.ndiff_bytes(a, b"int x;\nint z;\n")[0])
+    assert session.update(b"\0") is None
+
+
+@pytest.mark.parametrize("pool", ndiff.POOL_KINDS)
+def test_jobs_as_inline(pool, monkeypatch):
+    monkeypatch.setattr(ndiff, "POOL", pool)
+    monkeypatch.setattr(ndiff, "PARALLEL_MIN", 0)
+    monkeypatch.setattr(ndiff, "MEMO_SIZE", 0)
+    a = b"".join(b"int x%d = %d;\n" % (i, i) for i in range(60))
+    b = a.replace(b"x5 = 5", b"x5 = y + 5").replace(b"x30 =", b"z30 =").replace(b"x50 = 50;", b"x50 =\n\t50 + 1;")
+    (mid, unified) = ndiff.ndiff_bytes(a, b, context=3, jobs=1)
+    assert [b"".join(x) for x in ndiff.ndiff_bytes(a, b, context=3, jobs=2)] == [b"".join(mid), b"".join(unified)]
+
+
+## only the lines around the changes are split and shifted, however long
+## the unchanged lines between them
+def test_unified_large_file(write_pair, monkeypatch):
+    monkeypatch.setattr(ndiff, "LARGE_FILE", 0)
+    monkeypatch.setattr(wstats, "ENABLED", True)
+    monkeypatch.setattr(wstats, "counters", {})
+    a = b"".join(b"int x%d = %d;\n" % (i, i % 7) for i in range(50000))
+    b = a.replace(b"x100 = 2;", b"x100 = 3;").replace(b"x40000 = 2;", b"x40000 =  2; y;")
+    (file_a, file_b) = write_pair(a, b)
+    d = ndiff.diff_n(file_a, file_b)
+    tracemalloc.start()
+    try:
+        (mid, unified) = ndiff.ndiff_changes(d, context=3)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert wstats.counters["window_lines"] < 2000     ## of 100000
+    assert peak < len(a) // 8
+    assert b"".join(mid) == a.replace(b"x40000 = 2;", b"x40000 =  2;")
+    assert b"".join(unified).count(b"\n@@ ") == 1
+
+
+## the narrowest windows are widened until the shifts come out as over the
+## whole files
+@pytest.mark.parametrize("seed", range(PAIRS))
+def test_unified_windows(seed, monkeypatch):
+    (a, b) = make_pair(seed)
+    whole = ndiff.ndiff_bytes(a, b, context=3)
+    monkeypatch.setattr(ndiff, "SHIFT_MARGIN", 0)
+    assert ndiff.ndiff_bytes(a, b, context=3) == whole
+
+
+## with every hunk split on unique tokens first, the unified diff is still
+## the one of the midway text to b
+@pytest.mark.parametrize("seed", range(PAIRS))
+def test_anchored_unified_as_diff_up(seed, write_pair, tmp_path, monkeypatch):
+    monkeypatch.setattr(ndiff, "ANCHOR_MIN", 1)
+    (file_a, file_b) = write_pair(*make_pair(seed))
+    midway = str(tmp_path / "midway")
+    ndiff.ndiff(file_a, file_b, midway)
+    out = subprocess.run(["diff", "-U3", "-p", midway, file_b], stdout=subprocess.PIPE).stdout
+    assert b"".join(ndiff.ndiff_unified(file_a, file_b)) == b"".join(out.splitlines(keepends=True)[2:])
+
+
+## where the anchors agree with the whole diff, as with distinct tokens,
+## the output is the same
+
+def test_anchored_as_unanchored(monkeypatch):
+    monkeypatch.setattr(wstats, "ENABLED", True)
+    monkeypatch.setattr(wstats, "counters", {})
+    a = b"".join(b"int v%d = f%d(x, %d);\n" % (i, i, i) for i in range(200))
+    b = a.replace(b"v20 = f20(x, 20)", b"v20 =\n\tf20(y, 20)").replace(b"f150(x,", b"f150(x + 1,").replace(b"int v90", b"long v90")
+    monkeypatch.setattr(ndiff, "ANCHOR_MIN", 0)
+    whole = ndiff.ndiff_bytes(a, b, context=3)
+    monkeypatch.setattr(ndiff, "ANCHOR_MIN", 16)
+    assert ndiff.ndiff_bytes(a, b, context=3) == whole
+    assert 0 < wstats.counters["anchors"]
+
+
+@pytest.fixture
+def memo(monkeypatch):
+    monkeypatch.setattr(ndiff, "memo", ndiff.OrderedDict())
+    monkeypatch.setattr(ndiff, "memo_counts", {"hits": 0, "disk_hits": 0, "misses": 0, "bytes": 0})
+    return ndiff.memo_counts
+
+
+def joined(result):
+    return [b"".join(chunks) for chunks in result]
+
+
+def memo_pair():
+    a = b"".join(b"int x%d = %d;\n" % (i, i) for i in range(40))
+    return (a, a.replace(b"x5 = 5", b"x5 = y + 5").replace(b"x30 =", b"z30 ="))
+
+
+def test_memo_hits(memo):
+    (a, b) = memo_pair()
+    first = joined(ndiff.ndiff_bytes(a, b, context=3))
+    assert (ndiff.memo_counts["hits"], ndiff.memo_counts["misses"]) == (0, 2)
+    assert joined(ndiff.ndiff_bytes(a, b, context=3)) == first
+    assert (ndiff.memo_counts["hits"], ndiff.memo_counts["misses"]) == (2, 2)
+
+
+def test_memo_lru(memo, monkeypatch):
+    monkeypatch.setattr(ndiff, "MEMO_SIZE", 20)
+    for k in "abc":
+        ndiff.memo_store(k, k.encode() * 8)
+        if k == "b":
+            assert ndiff.memo_get("a") == b"a" * 8      ## now the most recent
+    assert list(ndiff.memo) == ["a", "c"]
+    assert ndiff.memo_get("b") is None
+    assert ndiff.memo_counts["bytes"] == 16
+    ndiff.memo_store("d", b"d" * 21)                    ## larger than the memo
+    assert list(ndiff.memo) == ["a", "c"]
+
+
+def test_memo_disk(memo, monkeypatch, tmp_path):
+    monkeypatch.setattr(ndiff, "MEMO_DISK", True)
+    monkeypatch.setattr(ndiff.wcache, "CACHE_DIR", str(tmp_path / "cache"))
+    (a, b) = memo_pair()
+    first = joined(ndiff.ndiff_bytes(a, b, context=3))
+    ndiff.memo.clear()
+    assert joined(ndiff.ndiff_bytes(a, b, context=3)) == first
+    assert (ndiff.memo_counts["disk_hits"], ndiff.memo_counts["misses"]) == (2, 2)
+    assert len(ndiff.memo) == 2
+
+
+## the tokens of tokenize() as it was before tokenizers were tables: one per
+## run of white space or of letters, digits and '_', and one per other
+## character
+def reference_tokens(line):
+    (r, token, prev) = ([], b"", None)
+    for c in line:
+        if c in b" \t\n\r":
+            kind = "space"
+        elif c in b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_":
+            kind = "word"
+        elif 0x80 <= c < 0xc0:
+            kind = "following"
+        else:
+            kind = "first" if 0xc0 <= c else "punctuation"
+        if kind != "following" and (kind in ("first", "punctuation") or kind != prev) and token:
+            r.append(token)
+            token = b""
+        prev = kind
+        token += bytes([c])
+    return r + [token] if token else r
+
+
+TOKEN_SAMPLES = [
+    b"static int f(int x)\n{\n\treturn x->y[2] + 0x1f; /* note */\n}\n",
+    b"def f(x, *args, **kw):\n    return {k: v for (k, v) in kw.items() if k != '_'}  # note\r\n",
+    b"Pl\xc3\xbcs de caf\xc3\xa9, \xe2\x80\x9cquoted\xe2\x80\x9d text\x01 and\xa9 stray bytes.\n",
+    b"   \t",
+    b"x",
+]
+
+
+@pytest.mark.parametrize("tokenizer", sorted(set(ndiff.TOKENIZERS.values()), key=lambda t: t.name))
+@pytest.mark.parametrize("sample", TOKEN_SAMPLES)
+def test_tokenizer_as_tokenize(tokenizer, sample):
+    tokens = ndiff.tokenize(sample, tokenizer)
+    assert [t.token for t in tokens] == reference_tokens(sample)
+    assert all(sample[t.start:t.end] == t.token for t in tokens)
+
+
+def test_tokenizer_for(monkeypatch):
+    for path in ("a.c", "dir.x/b.h", "c.cc"):
+        assert ndiff.tokenizer_for(path) is ndiff.c_tokenizer
+    for path in ("README", "a.py", "c.x/d"):
+        assert ndiff.tokenizer_for(path) is None
+    monkeypatch.setattr(ndiff, "TOKENIZERS", dict(ndiff.TOKENIZERS))
+    words = ndiff.Tokenizer("words", ndiff.byte_class_table(lambda c: b" "[0] if ndiff.isspace(c) else b"a"[0]), ndiff.re.compile(b" +|a+"))
+    ndiff.register_tokenizer(words, (".txt",))
+    assert ndiff.tokenizer_for("notes.txt") is words
+    assert [t.token for t in ndiff.tokenize(b"a-b c", words)] == [b"a-b", b" ", b"c"]
+
+
+## a hunk over budget is shown line by line, as plain diff shows it
+BUDGET_A = b"int x = 1;\nint y = 2;\n\nint z = 3;\n"
+BUDGET_B = b"int  x =\n\t1 + 1;\nint y = 2;\n\nlong z =  3;\n"
+
+
+def test_budget_tokens(memo):
+    (mid, unified) = joined(ndiff.ndiff_bytes(BUDGET_A, BUDGET_B, context=0))
+    assert mid == b"int  x =\n\t1;\nint y = 2;\n\nlong z =  3;\n"
+    budget = ndiff.Budget(hunk_tokens=10)       ## the first hunk has 12
+    (mid, unified) = joined(ndiff.ndiff_bytes(BUDGET_A, BUDGET_B, context=0, budget=budget))
+    assert mid == b"int x = 1;\nint y = 2;\n\nlong z =  3;\n"
+    assert unified == b"@@ -1 +1,2 @@\n-int x = 1;\n+int  x =\n+\t1 + 1;\n"
+    assert (budget.fallbacks, budget.timeouts) == (1, 0)
+    budget = ndiff.Budget(file_tokens=14)       ## the first hunk leaves 2
+    (mid, unified) = joined(ndiff.ndiff_bytes(BUDGET_A, BUDGET_B, context=0, budget=budget))
+    assert mid == b"int  x =\n\t1;\nint y = 2;\n\nint z = 3;\n"
+    assert unified.endswith(b"@@ -5 +5 @@ int y = 2;\n-int z = 3;\n+long z =  3;\n")
+    assert budget.fallbacks == 1
+
+
+## hunks that take a search, not only trimming their common ends
+@pytest.mark.parametrize("token_diff", ndiff.TOKEN_DIFF_BACKENDS)
+def test_budget_seconds(token_diff, memo):
+    a = b"int x = f(a, b, c);\nint y;\nint z = g(p, q, r);\n"
+    b = b"int  x = f(c, b, a);\nint y;\nint z =\n\tg(r, q, p);\n"
+    budget = ndiff.Budget(file_seconds=1)
+    budget.start -= 10          ## long past its deadline
+    assert b"".join(ndiff.ndiff_bytes(a, b, token_diff=token_diff, budget=budget)[0]) == a
+    assert (budget.fallbacks, budget.timeouts) == (2, 2)
+    assert b"".join(ndiff.ndiff_bytes(a, b, token_diff=token_diff)[0]) == b"int  x = f(a, b, c);\nint y;\nint z =\n\tg(p, q, r);\n"
+
+
+@pytest.mark.parametrize("seed", range(0, PAIRS, 5))
+def test_streamed_as_joined(seed, write_pair, tmp_path, monkeypatch):
+    (a, b) = make_pair(seed)
+    (file_a, file_b) = write_pair(a, b)
+    monkeypatch.setattr(ndiff, "WRITE_BATCH", 1)
+    ndiff.ndiff(file_a, file_b, str(tmp_path / "midway"))
+    result = ndiff.ndiff_bytes(a, b)
+    assert (tmp_path / "midway").read_bytes() == (b"".join(result[0]) if result else b"")
+
+
+def test_write_chunks(monkeypatch):
+    monkeypatch.setattr(ndiff, "WRITE_BATCH", 2)
+
+    class File:
+        batches = []
+
+        def writelines(self, batch):
+            self.batches.append(batch)
+    f = File()
+    ndiff.write_chunks(f, (c for c in [b"a", b"b", b"c"]))
+    assert f.batches == [[b"a", b"b"], [b"c"]]
+
+
+@pytest.mark.parametrize("seed", range(0, PAIRS, 5))
+@pytest.mark.parametrize("line_diff", ["myers", "diff"])
+def test_mapped_as_read(seed, line_diff, write_pair, tmp_path, monkeypatch):
+    (file_a, file_b) = write_pair(*make_pair(seed))
+    ndiff.ndiff(file_a, file_b, str(tmp_path / "read"), line_diff=line_diff)
+    unified = ndiff.ndiff_unified(file_a, file_b, line_diff=line_diff)
+    monkeypatch.setattr(ndiff, "LARGE_FILE", 1)
+    (r, lines_a, lines_b, raw_a, raw_b) = ndiff.diff_n(file_a, file_b, check=None, line_diff=line_diff)
+    assert raw_a.__class__ == mmap.mmap or len(raw_a) == 0
+    ndiff.ndiff(file_a, file_b, str(tmp_path / "mapped"), line_diff=line_diff)
+    assert (tmp_path / "mapped").read_bytes() == (tmp_path / "read").read_bytes()
+    assert b"".join(ndiff.ndiff_unified(file_a, file_b, line_diff=line_diff)) == b"".join(unified)
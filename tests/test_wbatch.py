@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def tuples(tmp_path, monkeypatch):
+    monkeypatch.setenv("WDIFF_CACHE", str(tmp_path / "cache"))
+    tuples = []
+    for k in range(5):
+        (file_a, file_b) = (tmp_path / f"a{k}.c", tmp_path / f"b{k}.c")
+        file_a.write_bytes(b"".join(b"int x%d = %d;\n" % (i, i) for i in range(10 * k)))
+        file_b.write_bytes(b"".join(b"int x%d = %d;\n" % (i, i + (i == k)) for i in range(10 * k + 1)))
+        tuples.append([f"f{k}.c", str(file_a), "0", "100644", str(file_b), "0", "100644"])
+    tuples.append(["README", str(file_a), "0", "100644", str(file_b), "0", "100644"])
+    return tuples
+
+
+def wdiff_each(tuples):
+    return b"".join(subprocess.run([sys.executable, os.path.join(ROOT, "wdiff.py")] + t, stdout=subprocess.PIPE, check=True).stdout for t in tuples)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_wbatch_as_wdiff(jobs, tuples):
+    lines = "".join(" ".join(t) + "\n" for t in tuples).encode()
+    out = subprocess.run([sys.executable, os.path.join(ROOT, "wbatch.py"), "-j", str(jobs)], input=lines, stdout=subprocess.PIPE, check=True).stdout
+    assert out == wdiff_each(tuples)
+
+
+def test_wbatch_nul_separated(tuples):
+    fields = b"".join(os.fsencode(e) + b"\0" for t in tuples for e in t)
+    out = subprocess.run([sys.executable, os.path.join(ROOT, "wbatch.py"), "-j", "2", "-z"], input=fields, stdout=subprocess.PIPE, check=True).stdout
+    assert out == wdiff_each(tuples)
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+import wcache
+
+BLOB_A = "1" * 40
+BLOB_B = "2" * 40
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(wcache, "CACHE_DIR", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+def test_key():
+    assert wcache.key("ndiff", BLOB_A, BLOB_B) != wcache.key("ndiff", BLOB_B, BLOB_A)
+    assert wcache.key("ndiff", BLOB_A, BLOB_B) != wcache.key("diff", BLOB_A, BLOB_B)
+    assert wcache.key("ndiff", "0" * 40, BLOB_B) is None
+    assert wcache.key("ndiff", BLOB_A, ".") is None
+
+
+def test_key_disabled(monkeypatch):
+    monkeypatch.setattr(wcache, "CACHE_SIZE", 0)
+    assert wcache.key("ndiff", BLOB_A, BLOB_B) is None
+
+
+def test_put_get():
+    k = wcache.key("ndiff", BLOB_A, BLOB_B)
+    assert wcache.get(k) is None
+    wcache.put(k, b"diff body\n")
+    assert wcache.get(k) == b"diff body\n"
+
+
+def test_get_without_utime(monkeypatch):
+    k = wcache.key("ndiff", BLOB_A, BLOB_B)
+    wcache.put(k, b"diff body\n")
+
+    def utime(path):
+        raise PermissionError(path)
+    monkeypatch.setattr(wcache.os, "utime", utime)
+    assert wcache.get(k) == b"diff body\n"
+
+
+def test_trim(cache_dir):
+    d = cache_dir / "ab"
+    d.mkdir(parents=True)
+    for (i, name) in enumerate(["old", "mid", "new"]):
+        (d / name).write_bytes(b"x" * 10)
+        os.utime(d / name, (i, i))
+    wcache.trim(str(d), 20)
+    assert sorted(os.listdir(d)) == ["mid", "new"]
@@ -0,0 +1,43 @@
+import pytest
+
+import wcache
+import wdiff
+
+BLOB_A = "1" * 40
+BLOB_B = "2" * 40
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(wcache, "CACHE_DIR", str(tmp_path / "cache"))
+
+
+def test_is_blob():
+    assert wcache.is_blob(BLOB_A)
+    assert wcache.is_blob("a" * 64)
+    assert not wcache.is_blob("0" * 40)
+    assert not wcache.is_blob("0")
+    assert not wcache.is_blob(".")
+
+
+@pytest.mark.parametrize("hash_", ["0", "0" * 40])
+def test_placeholder_hashes_are_diffed(hash_, tmp_path):
+    (file_a, file_b) = (tmp_path / "a.c", tmp_path / "b.c")
+    file_a.write_bytes(b"int a = 1;\n")
+    file_b.write_bytes(b"int a = 2;\n")
+    out = b"".join(wdiff.wdiff("a.c", str(file_a), hash_, "0", str(file_b), hash_, "0"))
+    assert b"@@ -1 +1 @@\n-int a = 1;\n+int a = 2;\n" in out
+
+
+def test_equal_blobs_give_the_header():
+    out = wdiff.wdiff("a.c", "/nonexistent/a.c", BLOB_A, "100644", "/nonexistent/b.c", BLOB_A, "100755")
+    assert b"".join(out) == b"diff -up a/a.c b/a.c\nindex 11111111..11111111 100755\n--- a/a.c\n+++ b/a.c\n"
+
+
+def test_wdiff_bytes_as_wdiff(tmp_path):
+    (a, b) = (b"int f(int x) { return x; }\n", b"int f(int x)\n{\n\treturn x + 1;\n}\n")
+    (file_a, file_b) = (tmp_path / "a.c", tmp_path / "b.c")
+    file_a.write_bytes(a)
+    file_b.write_bytes(b)
+    out = wdiff.wdiff("a.c", str(file_a), BLOB_A, "100644", str(file_b), BLOB_B, "100644")
+    assert b"".join(wdiff.wdiff_bytes("a.c", a, BLOB_A, "100644", b, BLOB_B, "100644")) == b"".join(out)
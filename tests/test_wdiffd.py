@@ -0,0 +1,97 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import wdiff
+import wdiffc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def pair(tmp_path):
+    (file_a, file_b) = (tmp_path / "a.c", tmp_path / "b.c")
+    file_a.write_bytes(b"int f(int x) { return x; }\n")
+    file_b.write_bytes(b"int f(int x)\n{\n\treturn x + 1;\n}\n")
+    ## placeholder hashes, so that neither side answers from the cache
+    return ["a.c", str(file_a), "0", "100644", str(file_b), "0", "100644"]
+
+
+@pytest.fixture
+def sock(tmp_path, monkeypatch):
+    path = str(tmp_path / "wdiff.sock")
+    monkeypatch.setenv("WDIFF_SOCKET", path)
+    monkeypatch.setenv("WDIFF_CACHE", str(tmp_path / "cache"))
+    return path
+
+
+@pytest.fixture
+def stats(tmp_path, monkeypatch):
+    path = str(tmp_path / "stats")
+    monkeypatch.setenv("NDIFF_STATS", path)
+    return path
+
+
+@pytest.fixture
+def server(sock):
+    p = subprocess.Popen([sys.executable, os.path.join(ROOT, "wdiffd.py"), "--socket", sock], stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(200):
+            if os.path.exists(sock):
+                break
+            time.sleep(0.05)
+        yield p
+    finally:
+        p.terminate()
+        p.wait()
+
+
+def test_forward(server, pair, capsysbinary):
+    assert wdiffc.forward(pair)
+    assert capsysbinary.readouterr().out == b"".join(wdiff.wdiff(*pair))
+
+
+def test_client_as_wdiff(server, pair):
+    out = subprocess.run([sys.executable, os.path.join(ROOT, "wdiffc.py")] + pair, stdout=subprocess.PIPE, check=True).stdout
+    assert out == b"".join(wdiff.wdiff(*pair))
+
+
+## one line of stats per request
+def test_stats(stats, server, pair, capsysbinary):
+    assert wdiffc.forward(pair)
+    assert wdiffc.forward(pair)
+    lines = [json.loads(line) for line in open(stats)]
+    assert [(e["program"], e["argv"]) for e in lines] == [("wdiffd", pair)] * 2
+    assert all(0 < e["counters"]["bytes_read"] and 0 < e["timers"]["write"]["calls"] for e in lines)
+
+
+def test_no_server(sock, pair):
+    assert not wdiffc.forward(pair)
+    out = subprocess.run([sys.executable, os.path.join(ROOT, "wdiffc.py")] + pair, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    assert out == b"".join(wdiff.wdiff(*pair))
+
+
+def test_other_settings(server, pair, monkeypatch):
+    monkeypatch.setenv("NDIFF_VERIFY", "off" if os.environ.get("NDIFF_VERIFY") == "full" else "full")
+    assert not wdiffc.forward(pair)
+
+
+def test_socket_of_another_user(server, pair, monkeypatch):
+    uid = os.getuid()
+    monkeypatch.setattr(wdiffc.os, "getuid", lambda: uid + 1)
+    assert not wdiffc.forward(pair)
+
+
+def test_timeout(sock, pair, monkeypatch):
+    monkeypatch.setattr(wdiffc, "TIMEOUT", 0.2)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.bind(sock)
+        s.listen()      ## never accepts nor answers
+        start = time.monotonic()
+        assert not wdiffc.forward(pair)
+        assert time.monotonic() - start < 5
@@ -0,0 +1,100 @@
+#! /usr/bin/python3
+
+## batch driver for wdiff.py.  reads many
+##   pretty file_a hash_a mode_a file_b hash_b mode_b
+## tuples from stdin, one per line (or NUL separated fields with -z), runs
+## them across a pool of worker processes and writes the results in input order.
+## with -p each tuple has an 8th field, a file holding git's unified diff of
+## the pair (`git diff -U0`), which is used instead of running diff.
+
+import argparse
+import multiprocessing
+import os
+import sys
+from syslog import openlog, syslog, LOG_PID, LOG_PERROR, LOG_LOCAL7, LOG_ERR
+import wdiff
+import wstats
+
+
+def main():
+    openlog(os.path.basename(__file__), LOG_PID | LOG_PERROR, LOG_LOCAL7)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("-z", action="store_true", help="fields are separated by NUL")
+    parser.add_argument("-p", "--patches", action="store_true", help="an 8th field names a file with the git diff -U0 of the pair")
+    args = parser.parse_args()
+
+    tuples = read_tuples(sys.stdin.buffer, args.z, 8 if args.patches else 7)
+    wstats.start("wbatch")
+    try:
+        if args.jobs <= 1:
+            failed = write_results(map(run, tuples))
+        else:
+            ## workers start with no counts of their own, whatever they forked with
+            with multiprocessing.Pool(args.jobs, initializer=wstats.take) as pool:
+                failed = write_results(merged(pool.imap(run_counted, tuples)))
+    finally:
+        wstats.finish()
+    return 1 if failed else 0
+
+
+def read_tuples(f, nul_separated, n=7):
+    if nul_separated:
+        fields = f.read().split(b"\0")
+        if fields[-1] == b"":
+            fields.pop()
+        if len(fields) % n != 0:
+            raise Exception(f"number of fields {len(fields)} is not a multiple of {n}")
+        for i in range(0, len(fields), n):
+            yield [os.fsdecode(e) for e in fields[i:i + n]]
+    else:
+        for line in f:
+            fields = line.split()
+            if fields == []:
+                continue
+            if len(fields) != n:
+                raise Exception(f"expected {n} fields: {line}")
+            yield [os.fsdecode(e) for e in fields]
+
+
+def run(argv):
+    try:
+        if len(argv) == 8:
+            with open(argv[7], "rb") as f:
+                return (True, wdiff.wdiff(*argv[:7], patch=f.read()))
+        return (True, wdiff.wdiff(*argv))
+    except Exception as e:
+        syslog(LOG_ERR, f"{argv[0]}: {e}")
+        return (False, [])
+
+
+"""
+run() in a worker, with the counters and timers of the run for the parent
+to merge (None when stats are off).
+"""
+def run_counted(argv):
+    result = run(argv)
+    return (result, wstats.take() if wstats.ENABLED else None)
+
+
+def merged(results):
+    for (result, stats) in results:
+        if stats is not None:
+            wstats.merge(stats)
+        yield result
+
+
+def write_results(results):
+    failed = 0
+    out = sys.stdout.buffer
+    for (ok, chunks) in results:
+        out.writelines(chunks)
+        if not ok:
+            failed += 1
+    out.flush()
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(main())
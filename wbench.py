@@ -0,0 +1,266 @@
+#! /usr/bin/python3
+
+## benchmarks for ndiff.py and wdiff.py.  generates a reproducible corpus of
+## C source pairs (plain token edits, reindents, brace reflows, CRLF and
+## UTF-8 heavy files, of several sizes), times each stage on every pair and
+## writes the timings as JSON, so runs on different commits can be compared.
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+from subprocess import run, DEVNULL, PIPE
+import sys
+import tempfile
+import time
+
+## repeats would time the hunk memo instead of the work
+os.environ.setdefault("NDIFF_MEMO_SIZE", "0")
+import ndiff
+
+## lines of each size of generated file
+SIZES = {"small": 200, "medium": 5000, "large": 50000}
+
+## edits applied to file_a to make file_b
+EDITS = ("tokens", "reindent", "reflow", "crlf", "utf8")
+
+STAGES = ("readfile", "diff_n", "changed", "changelist_to_midway", "ndiff_unified", "wdiff")
+
+IDENTIFIERS = ["i", "j", "n", "len", "buf", "ctx", "node", "next", "count", "result", "flags", "offset", "tmp", "p", "q"]
+TYPES = ["int", "long", "size_t", "char *", "struct node *", "unsigned", "void *"]
+CALLS = ["memcpy", "strlen", "malloc", "free", "printf", "assert", "list_add", "hash_update", "lock", "unlock"]
+WORDS = ["the", "buffer", "is", "freed", "later", "when", "count", "drops", "to", "zero", "see", "above"]
+UTF8_WORDS = ["バッファ", "解放", "カウンタ", "ゼロ", "über", "naïve", "résumé", "Ωμέγα", "данные", "🙂"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default="-", help="JSON output file (default stdout)")
+    parser.add_argument("-d", "--corpus", help="keep the corpus in this directory")
+    parser.add_argument("-n", "--repeat", type=int, default=3)
+    parser.add_argument("-s", "--seed", type=int, default=1)
+    parser.add_argument("--sizes", default=",".join(SIZES), help="comma separated subset of " + ",".join(SIZES))
+    parser.add_argument("--edits", default=",".join(EDITS), help="comma separated subset of " + ",".join(EDITS))
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated subset of " + ",".join(STAGES))
+    args = parser.parse_args()
+
+    sizes = args.sizes.split(",")
+    edits = args.edits.split(",")
+    stages = args.stages.split(",")
+    for (name, chosen, known) in (("size", sizes, SIZES), ("edit", edits, EDITS), ("stage", stages, STAGES)):
+        for e in chosen:
+            if e not in known:
+                parser.error(f"unknown {name}: {e}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = args.corpus or tmp
+        os.makedirs(corpus, exist_ok=True)
+        pairs = make_corpus(corpus, sizes, edits, args.seed)
+        results = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "config": {"token_diff": ndiff.TOKEN_DIFF, "line_diff": ndiff.LINE_DIFF, "jobs": ndiff.JOBS, "verify": ndiff.VERIFY, "memo_size": ndiff.MEMO_SIZE},
+            "cases": [bench_pair(name, file_a, file_b, stages, args.repeat) for (name, file_a, file_b) in pairs],
+        }
+
+    out = json.dumps(results, indent=1) + "\n"
+    if args.output == "-":
+        sys.stdout.write(out)
+    else:
+        with open(args.output, "w") as f:
+            f.write(out)
+    return 0
+
+
+"""
+writes a pair of files per size and edit to `directory`.
+returns [(name, file_a, file_b)].  the same seed gives the same files.
+"""
+def make_corpus(directory, sizes, edits, seed):
+    pairs = []
+    for size in sizes:
+        for edit in edits:
+            rng = random.Random(f"{seed}-{size}-{edit}")
+            a = c_source(rng, SIZES[size], utf8=(edit == "utf8"))
+            b = EDIT_FUNCTIONS[edit](rng, a)
+            if edit == "crlf":
+                a = a.replace("\n", "\r\n")
+            name = f"{size}-{edit}"
+            file_a = os.path.join(directory, name + "_a.c")
+            file_b = os.path.join(directory, name + "_b.c")
+            with open(file_a, "wb") as f:
+                f.write(a.encode())
+            with open(file_b, "wb") as f:
+                f.write(b.encode())
+            pairs.append((name, file_a, file_b))
+    return pairs
+
+
+"""
+K&R style C of about n lines: functions of declarations, calls, ifs and
+loops, with block and line comments.
+"""
+def c_source(rng, n, utf8=False):
+    words = WORDS + UTF8_WORDS * 3 if utf8 else WORDS
+    out = ["#include <stdio.h>", "#include <stdlib.h>", ""]
+    k = 0
+    while len(out) < n:
+        out.append("/* " + " ".join(rng.choice(words) for _ in range(rng.randint(3, 10))) + " */")
+        out.append(f"static {rng.choice(TYPES)}")
+        out.append(f"f{k}({rng.choice(TYPES)} {rng.choice(IDENTIFIERS)}, {rng.choice(TYPES)} {rng.choice(IDENTIFIERS)}) {{")
+        c_block(rng, out, 1, rng.randint(4, 30), words)
+        out.append("}")
+        out.append("")
+        k += 1
+    return "\n".join(out) + "\n"
+
+
+def c_block(rng, out, depth, n, words):
+    indent = "    " * depth
+    for _ in range(n):
+        x = rng.random()
+        if x < 0.1 and depth < 4:
+            out.append(f"{indent}if ({rng.choice(IDENTIFIERS)} {rng.choice(['<', '==', '!=', '>='])} {rng.randint(0, 99)}) {{")
+            c_block(rng, out, depth + 1, rng.randint(1, 5), words)
+            out.append(f"{indent}}}")
+        elif x < 0.15 and depth < 4:
+            v = rng.choice(IDENTIFIERS)
+            out.append(f"{indent}for ({v} = 0; {v} < {rng.choice(IDENTIFIERS)}; {v}++) {{")
+            c_block(rng, out, depth + 1, rng.randint(1, 5), words)
+            out.append(f"{indent}}}")
+        elif x < 0.25:
+            out.append(f"{indent}// " + " ".join(rng.choice(words) for _ in range(rng.randint(2, 8))))
+        elif x < 0.3:
+            out.append(f'{indent}printf("' + " ".join(rng.choice(words) for _ in range(rng.randint(1, 5))) + '\\n");')
+        elif x < 0.6:
+            args = ", ".join(rng.choice(IDENTIFIERS) for _ in range(rng.randint(1, 3)))
+            out.append(f"{indent}{rng.choice(IDENTIFIERS)} = {rng.choice(CALLS)}({args});")
+        else:
+            out.append(f"{indent}{rng.choice(IDENTIFIERS)} {rng.choice(['=', '+=', '-=', '|='])} {rng.choice(IDENTIFIERS)} {rng.choice(['+', '*', '&', '>>'])} {rng.randint(0, 255)};")
+
+
+def edit_tokens(rng, s):
+    lines = s.split("\n")
+    for _ in range(max(1, len(lines) // 50)):
+        i = rng.randrange(len(lines))
+        x = rng.random()
+        if x < 0.4:
+            lines[i] = lines[i].replace(rng.choice(IDENTIFIERS), rng.choice(IDENTIFIERS), 1)
+        elif x < 0.6:
+            lines.insert(i, lines[rng.randrange(len(lines))])
+        elif x < 0.8:
+            del lines[i]
+        else:
+            lines[i] = lines[i].replace(";", "; /* " + rng.choice(WORDS) + " */", 1)
+    return "\n".join(lines)
+
+
+"""
+whitespace only: 4 columns to 8, or to tabs, in a few regions.
+"""
+def edit_reindent(rng, s):
+    lines = s.split("\n")
+    for _ in range(max(1, len(lines) // 500)):
+        i = rng.randrange(len(lines))
+        new = rng.choice(["        ", "\t"])
+        for j in range(i, min(i + rng.randint(20, 200), len(lines))):
+            stripped = lines[j].lstrip(" ")
+            lines[j] = new * ((len(lines[j]) - len(stripped)) // 4) + stripped
+    return "\n".join(lines)
+
+
+"""
+whitespace and newlines only: K&R braces to Allman, and some short
+statements joined onto one line.
+"""
+def edit_reflow(rng, s):
+    out = []
+    for line in s.split("\n"):
+        if line.endswith(") {") and rng.random() < 0.5:
+            indent = line[:len(line) - len(line.lstrip())]
+            out.append(line[:-2])
+            out.append(indent + "{")
+        elif out and line.endswith(";") and out[-1].endswith(";") and rng.random() < 0.1:
+            out[-1] += " " + line.strip()
+        else:
+            out.append(line)
+    return "\n".join(out)
+
+
+def edit_crlf(rng, s):
+    return edit_tokens(rng, s).replace("\n", "\r\n")
+
+
+def edit_utf8(rng, s):
+    lines = edit_tokens(rng, s).split("\n")
+    for _ in range(max(1, len(lines) // 50)):
+        i = rng.randrange(len(lines))
+        for w in WORDS:
+            if w in lines[i]:
+                lines[i] = lines[i].replace(w, rng.choice(UTF8_WORDS), 1)
+                break
+    return "\n".join(lines)
+
+
+EDIT_FUNCTIONS = {
+    "tokens": edit_tokens,
+    "reindent": edit_reindent,
+    "reflow": edit_reflow,
+    "crlf": edit_crlf,
+    "utf8": edit_utf8,
+}
+
+
+"""
+times each stage on one pair `repeat` times.  changed() and
+changelist_to_midway() run on a changelist made beforehand, so their times
+do not include reading and diffing the lines.  diff_n() includes reading
+both files, ndiff_unified() starts from the files too, and wdiff runs the
+whole path in a new process, as git runs it.
+"""
+def bench_pair(name, file_a, file_b, stages, repeat):
+    (r, lines_a, lines_b, raw_a, raw_b) = ndiff.diff_n(file_a, file_b)
+    hunks = [e for e in r if e.__class__ == ndiff.Changed]
+    case = {
+        "name": name,
+        "bytes": [os.path.getsize(file_a), os.path.getsize(file_b)],
+        "lines": [len(lines_a) - 2, len(lines_b) - 2],
+        "changed_hunks": len(hunks),
+        "stages": {},
+    }
+
+    def wdiff():
+        env = dict(os.environ, WDIFF_CACHE_SIZE="0")
+        wdiff_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wdiff.py")
+        cmd = [sys.executable, wdiff_py, "x.c", file_a, "0" * 40, "100644", file_b, "1" * 40, "100644"]
+        run(cmd, stdout=DEVNULL, stderr=PIPE, env=env, check=True)
+
+    functions = {
+        "readfile": lambda: (ndiff.readfile(file_a), ndiff.readfile(file_b)),
+        "diff_n": lambda: ndiff.diff_n(file_a, file_b),
+        "changed": lambda: [ndiff.changed(e) for e in hunks],
+        "changelist_to_midway": lambda: ndiff.changelist_to_midway(r, lines_a, lines_b),
+        "ndiff_unified": lambda: ndiff.ndiff_unified(file_a, file_b),
+        "wdiff": wdiff,
+    }
+    for stage in stages:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            functions[stage]()
+            times.append(time.perf_counter() - start)
+        case["stages"][stage] = {"min": min(times), "median": statistics.median(times)}
+    return case
+
+
+def git_commit():
+    p = run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=PIPE, stderr=DEVNULL)
+    return p.stdout.decode().strip() if p.returncode == 0 else None
+
+
+if __name__ == "__main__":
+    sys.exit(main())
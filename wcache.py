@@ -0,0 +1,111 @@
+## on-disk cache of wdiff.py results, content-addressed by the blob hashes
+## git passes to GIT_EXTERNAL_DIFF.
+##
+## entries live in <dir>/<2 hex digits>/<rest of key> and are written to a
+## tempfile and renamed into place, so readers never see a partial entry.
+## a hit touches the entry; a store trims its subdirectory to 1/256 of the
+## size limit, least recently used first.
+
+import hashlib
+import os
+import re
+import tempfile
+from syslog import syslog, LOG_ERR
+
+
+CACHE_DIR = os.environ.get("WDIFF_CACHE") or os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "wdiff")
+CACHE_SIZE = int(os.environ.get("WDIFF_CACHE_SIZE", 256 << 20))     ## bytes, 0 disables the cache
+
+SOURCES = ["ndiff.py", "wdiff.py"]      ## the output depends on these
+
+blob_hash = re.compile(r"[0-9a-f]{40}|[0-9a-f]{64}")    ## sha1 or sha256 object name
+version = None
+
+
+"""
+cache key for the diff of two blobs, or None when the pair is not cacheable
+(cache disabled, worktree file or /dev/null, which git passes with a null
+or '.' hash).
+"""
+def key(kind, hash_a, hash_b):
+    if CACHE_SIZE <= 0:
+        return None
+    if not is_blob(hash_a) or not is_blob(hash_b):
+        return None
+    return hashlib.sha1(f"{tool_version()} {kind} {hash_a} {hash_b}".encode()).hexdigest()
+
+
+"""
+whether h names a blob: a full object name, and not the null one.
+"""
+def is_blob(h):
+    return blob_hash.fullmatch(h) is not None and h.strip("0") != ""
+
+
+def tool_version():
+    global version
+    if version is None:
+        h = hashlib.sha1()
+        for name in SOURCES:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as f:
+                h.update(f.read())
+        version = h.hexdigest()
+    return version
+
+
+def entry_path(key):
+    return os.path.join(CACHE_DIR, key[:2], key[2:])
+
+
+def get(key):
+    path = entry_path(key)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None     ## miss, or evicted under our feet
+    try:
+        os.utime(path)
+    except OSError:
+        pass            ## read-only cache, or evicted since the read
+    return data
+
+
+def put(key, data):
+    path = entry_path(key)
+    d = os.path.dirname(path)
+    try:
+        os.makedirs(d, exist_ok=True)
+        (fd, tmp) = tempfile.mkstemp(dir=d, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        trim(d, CACHE_SIZE // 256)
+    except OSError as e:
+        syslog(LOG_ERR, f"cache: {e}")
+
+
+def trim(d, limit):
+    entries = []
+    for e in os.scandir(d):
+        if e.name.startswith(".tmp"):
+            continue
+        try:
+            st = e.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, e.path))
+    total = sum(size for (mtime, size, path) in entries)
+    entries.sort()
+    for (mtime, size, path) in entries:
+        if total <= limit:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -7,10 +7,22 @@ from subprocess import Popen, PIPE
 import sys
 from syslog import openlog, syslog, LOG_PID, LOG_PERROR, LOG_LOCAL7, LOG_DEBUG, LOG_ERR
 import tempfile
+import wcache
+import wstats
+
+## lines of context in the unified output
+CONTEXT = int(os.environ.get("WDIFF_CONTEXT", 3))
+
+## how the unified diff of the midway file is made
+##   "ndiff" : ndiff.ndiff_unified(), straight from the changelist
+##   "diff"  : write the midway file and run `diff -up` on it (reference)
+UNIFIED = os.environ.get("WDIFF_UNIFIED", "ndiff")
+
+## ndiff's self-checks: "off", "sampled" or "full" (see ndiff.VERIFY_LEVELS)
+VERIFY = os.environ.get("WDIFF_VERIFY", ndiff.VERIFY)
 
 def main():
     openlog(os.path.basename(__file__), LOG_PID | LOG_PERROR, LOG_LOCAL7)
-    #syslog(LOG_DEBUG, f"argv={len(sys.argv)} argv={sys.argv}")
     if len(sys.argv) != 8:
         print(f"{sys.argv}")
         return 0
@@ -27,45 +39,135 @@ def main():
     parser.add_argument("hash_b")
     parser.add_argument("mode_b")
 
-    #syslog(LOG_DEBUG, f"{args.pretty}")
-    #syslog(LOG_DEBUG, f"{args.file_a}")
-    #syslog(LOG_DEBUG, f"{args.hash_a}")
-    #syslog(LOG_DEBUG, f"{args.mode_a}")
-    #syslog(LOG_DEBUG, f"{args.file_b}")
-    #syslog(LOG_DEBUG, f"{args.hash_b}")
-    #syslog(LOG_DEBUG, f"{args.mode_b}")
-
     args = parser.parse_args()
 
-    if not args.pretty.endswith((".c", ".cc", ".h")) or args.file_a == "/dev/null" or args.file_b == "/dev/null":
-        df = diff_files(args.file_a, args.file_b)
-    else:
+    wstats.start("wdiff")
+    try:
+        out = wdiff(args.pretty, args.file_a, args.hash_a, args.mode_a, args.file_b, args.hash_b, args.mode_b)
+        with wstats.timer("write"):
+            sys.stdout.buffer.writelines(out)
+            sys.stdout.buffer.flush()
+    finally:
+        wstats.finish()
+
+    return 0
+
+
+"""
+the whole work of one GIT_EXTERNAL_DIFF invocation.
+returns the output as a list of bytes.  equal blob hashes (a mode change)
+give the header alone, without reading the files; placeholder hashes (the
+`wdiff` script's 0, git's null hash for worktree files) are left to the
+byte compare of ndiff.precheck().  patch is git's unified diff of the two
+blobs (`git diff -U0`), used as the line diff when given.
+"""
+def wdiff(pretty, file_a, hash_a, mode_a, file_b, hash_b, mode_b, patch=None):
+    if hash_a == hash_b and wcache.is_blob(hash_a):
+        return with_header(pretty, hash_a, hash_b, mode_b, b"")
+    tokenizer = ndiff.tokenizer_for(pretty)
+    kind = body_kind(tokenizer, file_a == "/dev/null" or file_b == "/dev/null", patch=patch)
+    budget = ndiff.Budget()
+
+    def body():
+        if kind == "diff":
+            return b"".join(diff_files(file_a, file_b)[2:])
+        if UNIFIED == "ndiff":
+            return b"".join(ndiff.ndiff_unified(file_a, file_b, context=CONTEXT, verify=VERIFY, tokenizer=tokenizer, budget=budget, patch=patch))
         try:
             with tempfile.NamedTemporaryFile(mode="wb", delete=False) as f:
                 f_name = f.name
-            ndiff.ndiff(args.file_a, args.file_b, f_name)
-            df = diff_files(f_name, args.file_b)
+            ndiff.ndiff(file_a, file_b, f_name, verify=VERIFY, tokenizer=tokenizer, budget=budget, patch=patch)
+            return b"".join(diff_files(f_name, file_b)[2:])
         finally:
             os.unlink(f_name)
 
-    pretty = args.pretty.encode()
-    index_a = args.hash_a[:8].encode()
-    index_b = args.hash_b[:8].encode()
-    mode = f"{args.mode_b}".encode()
-
-    sys.stdout.buffer.write(b"diff -up a/" + pretty + b" b/" + pretty + b"\n")
-    sys.stdout.buffer.write(b"index " + index_a + b".." + index_b + b" " + mode +  b"\n")
-    sys.stdout.buffer.write(b"--- a/" + pretty + b"\n")
-    sys.stdout.buffer.write(b"+++ b/" + pretty + b"\n")
-    for e in df[2:]:
-        sys.stdout.buffer.write(e)
-
-    return 0
+    return with_header(pretty, hash_a, hash_b, mode_b, cached_body(kind, hash_a, hash_b, body, budget))
+
+
+"""
+wdiff() of two blobs in memory, with no filesystem I/O: a or b is None
+where git would pass /dev/null.  the line diffs run in-process, so this
+does not follow WDIFF_UNIFIED, and plain diffs are ndiff.unified_bytes(),
+which may line up apart from `diff -up`: they are cached as a kind of
+their own.
+"""
+def wdiff_bytes(pretty, a, hash_a, mode_a, b, hash_b, mode_b, patch=None):
+    if hash_a == hash_b and wcache.is_blob(hash_a):
+        return with_header(pretty, hash_a, hash_b, mode_b, b"")
+    tokenizer = ndiff.tokenizer_for(pretty)
+    kind = body_kind(tokenizer, a is None or b is None, unified="ndiff", patch=patch)
+    if kind == "diff":
+        kind = "diff-inproc"
+    (a, b) = (b"" if a is None else a, b"" if b is None else b)
+    budget = ndiff.Budget()
+
+    def body():
+        if kind == "diff-inproc":
+            return b"".join(ndiff.unified_bytes(a, b, context=CONTEXT))
+        result = ndiff.ndiff_bytes(a, b, context=CONTEXT, verify=VERIFY, tokenizer=tokenizer, budget=budget, patch=patch)
+        return b"" if result is None else b"".join(result[1])
+
+    return with_header(pretty, hash_a, hash_b, mode_b, cached_body(kind, hash_a, hash_b, body, budget))
+
+
+"""
+files without a tokenizer (see ndiff.register_tokenizer()), and added or
+deleted files, get a plain `diff -up`.  ANCHOR_MIN changes how large
+hunks line up, so it is part of the kind.  token budgets change which
+hunks fall back to lines, so they are part of the kind when set, and so is a
+patch from git, which may align the lines differently from diff.  with
+the white space check off, changes of white space only show as hunks.
+"""
+def body_kind(tokenizer, dev_null, unified=UNIFIED, patch=None):
+    if tokenizer is None or dev_null:
+        return "diff"
+    kind = f"ndiff-{tokenizer.name}-{ndiff.TOKEN_DIFF}-{ndiff.LINE_DIFF}-{unified}-A{ndiff.ANCHOR_MIN}"
+    if patch is not None:
+        kind += "-git"
+    if not ndiff.WHITESPACE_CHECK:
+        kind += "-W0"
+    if ndiff.HUNK_TOKENS or ndiff.FILE_TOKENS:
+        kind += f"-T{ndiff.HUNK_TOKENS}.{ndiff.FILE_TOKENS}"
+    return kind
+
+
+"""
+body() through the cache.  the body does not depend on the file name,
+only on the blobs.  a body with hunks that ran out of time is not cached:
+another run, or another machine, may finish them.
+"""
+def cached_body(kind, hash_a, hash_b, body, budget=None):
+    cache_key = wcache.key(f"{kind}-U{CONTEXT}", hash_a, hash_b)
+    cached = wcache.get(cache_key) if cache_key else None
+    if cache_key:
+        wstats.count("cache_hits" if cached is not None else "cache_misses")
+    if cached is not None:
+        return cached
+    out = body()
+    if cache_key and (budget is None or budget.timeouts == 0):
+        wcache.put(cache_key, out)
+    return out
+
+
+def with_header(pretty, hash_a, hash_b, mode_b, body):
+    pretty = pretty.encode()
+    index_a = hash_a[:8].encode()
+    index_b = hash_b[:8].encode()
+    mode = f"{mode_b}".encode()
+
+    out = []
+    out.append(b"diff -up a/" + pretty + b" b/" + pretty + b"\n")
+    out.append(b"index " + index_a + b".." + index_b + b" " + mode +  b"\n")
+    out.append(b"--- a/" + pretty + b"\n")
+    out.append(b"+++ b/" + pretty + b"\n")
+    out.append(body)
+
+    return out
 
 
 def diff_files(file_a, file_b):
-    cmd = ["diff", "-up", file_a, file_b]
-    with Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE) as p:
+    cmd = ["diff", f"-U{CONTEXT}", "-p", file_a, file_b]
+    with wstats.timer("diff"), Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE) as p:
         try:
             (out, err) = p.communicate()
             p.wait()
@@ -0,0 +1,83 @@
+#! /usr/bin/python3 -S
+
+## GIT_EXTERNAL_DIFF client.  forwards the 7 arguments to a running
+## wdiffd.py and streams back its output.  falls back to wdiff.py
+## in-process when no server is running, when the socket is not ours, when
+## the server does not answer within TIMEOUT seconds, or when it runs with
+## other WDIFF_*/NDIFF_* settings than ours.
+## imports are kept to the minimum on purpose; this runs once per file.
+
+import os
+import socket
+import sys
+
+## seconds to connect, and then to wait for each part of the response
+TIMEOUT = float(os.environ.get("WDIFF_TIMEOUT", 60))
+CONNECT_TIMEOUT = 1
+
+## settings that are the client's own, not the server's
+CLIENT_ONLY = ("WDIFF_SOCKET", "WDIFF_TIMEOUT")
+
+
+def main():
+    if len(sys.argv) == 8 and forward(sys.argv[1:]):
+        return 0
+    import wdiff
+    return wdiff.main()
+
+
+def socket_path():
+    path = os.environ.get("WDIFF_SOCKET")
+    if path:
+        return path
+    return os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp", f"wdiff-{os.getuid()}.sock")
+
+
+"""
+the WDIFF_*/NDIFF_* settings of an environment that change the output, as
+NAME=value strings.
+"""
+def settings(environ):
+    return sorted(f"{k}={v}" for (k, v) in environ.items() if k.startswith(("WDIFF_", "NDIFF_")) and k not in CLIENT_ONLY)
+
+
+"""
+request  : cwd, the 7 arguments and settings(), separated by NUL.  end of
+           request is SHUT_WR.
+response : b"O" followed by the output, or b"E" when the server failed or
+           its settings differ.
+a timeout once the output has started is an error: it cannot be taken back.
+"""
+def forward(argv):
+    path = socket_path()
+    try:
+        if os.stat(path).st_uid != os.getuid():
+            return False        ## someone else's socket could serve anything
+    except OSError:
+        return False
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            s.settimeout(CONNECT_TIMEOUT)
+            s.connect(path)
+            s.settimeout(TIMEOUT)
+            s.sendall(b"\0".join([os.fsencode(os.getcwd())] + [os.fsencode(e) for e in argv + settings(os.environ)]))
+            s.shutdown(socket.SHUT_WR)
+            if s.recv(1) != b"O":
+                return False
+        except OSError:         ## socket.timeout included
+            return False
+        out = sys.stdout.buffer
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            out.write(chunk)
+        out.flush()
+        return True
+    finally:
+        s.close()
+
+
+if __name__ == "__main__":
+    main()
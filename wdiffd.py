@@ -0,0 +1,113 @@
+#! /usr/bin/python3
+
+## long-lived server for wdiffc.py.  keeps the interpreter and ndiff loaded,
+## so each file git hands to GIT_EXTERNAL_DIFF costs only a socket round trip.
+
+import argparse
+import contextlib
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from syslog import openlog, syslog, LOG_PID, LOG_PERROR, LOG_LOCAL7, LOG_INFO, LOG_ERR, LOG_WARNING
+import wdiff
+import wdiffc
+import wstats
+
+## the settings wdiff and ndiff were loaded with.  a client with others is
+## sent back to run in-process, so that its settings are the ones that apply.
+SETTINGS = wdiffc.settings(os.environ)
+warned = set()
+
+## with NDIFF_STATS, requests take turns, so that each line of the stats
+## file is the work of one request
+stats_lock = threading.Lock()
+
+
+def main():
+    openlog(os.path.basename(__file__), LOG_PID | LOG_PERROR, LOG_LOCAL7)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", default=wdiffc.socket_path())
+    args = parser.parse_args()
+
+    serve(args.socket)
+    return 0
+
+
+def serve(path):
+    if os.path.exists(path):
+        if in_use(path):
+            syslog(LOG_ERR, f"{path} is in use by another server")
+            return
+        os.unlink(path)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    old_umask = os.umask(0o077)                 ## the server reads any file the user can read
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(old_umask)
+    try:
+        syslog(LOG_INFO, f"listening on {path}")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def in_use(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except OSError:
+            return False
+    return True
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        (cwd, *argv) = [os.fsdecode(e) for e in self.rfile.read().split(b"\0")]
+        with stats_lock if wstats.ENABLED else contextlib.nullcontext():
+            wstats.start("wdiffd", argv[:7])
+            try:
+                self.respond(cwd, argv)
+            finally:
+                wstats.finish()
+
+    def respond(self, cwd, argv):
+        try:
+            if len(argv) < 7:
+                raise Exception(f"bad request argv={argv}")
+            (pretty, file_a, hash_a, mode_a, file_b, hash_b, mode_b) = argv[:7]
+            if argv[7:] != SETTINGS:
+                differ = " ".join(sorted(set(argv[7:]) ^ set(SETTINGS)))
+                if differ not in warned:
+                    warned.add(differ)
+                    syslog(LOG_WARNING, f"client settings differ ({differ}), sent back to run in-process")
+                self.wfile.write(b"E")
+                return
+            ## git passes worktree files relative to its cwd
+            file_a = os.path.join(cwd, file_a)
+            file_b = os.path.join(cwd, file_b)
+            out = wdiff.wdiff(pretty, file_a, hash_a, mode_a, file_b, hash_b, mode_b)
+        except Exception as e:
+            syslog(LOG_ERR, f"{e}")
+            self.wfile.write(b"E")
+            return
+        with wstats.timer("write"):
+            self.wfile.write(b"O")
+            self.wfile.writelines(out)
+            self.wfile.flush()
+
+
+if __name__ == "__main__":
+    main()
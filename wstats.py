@@ -0,0 +1,119 @@
+## counters and timers for ndiff.py and wdiff.py.
+##
+## off unless NDIFF_STATS names a file.  then start() and finish() around a
+## run append one JSON line with the counters and timers of the run to that
+## file; each line is a single write to a file opened O_APPEND, so the git
+## processes running wdiff.py side by side do not mix their lines.
+## NDIFF_PROFILE names a file to dump a cProfile of the run to (".<pid>"
+## is appended), whether or not NDIFF_STATS is set.
+##
+## when off, count() is a test and timer() returns a shared no-op context.
+
+import contextlib
+import os
+import sys
+import time
+
+
+STATS_FILE = os.environ.get("NDIFF_STATS", "")
+PROFILE_FILE = os.environ.get("NDIFF_PROFILE", "")
+ENABLED = STATS_FILE != ""
+
+counters = {}       ## name -> count
+timers = {}         ## name -> [seconds, calls]
+run = None          ## (program, start time, profiler) of the current run
+
+null_timer = contextlib.nullcontext()
+
+
+def count(name, n=1):
+    if ENABLED:
+        counters[name] = counters.get(name, 0) + n
+
+
+"""
+with timer("diff"): ...  adds the time of the block and one call to "diff".
+"""
+def timer(name):
+    if not ENABLED:
+        return null_timer
+    return Timer(name)
+
+
+class Timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        t = timers.setdefault(self.name, [0.0, 0])
+        t[0] += time.perf_counter() - self.start
+        t[1] += 1
+        return False
+
+
+"""
+the counters and timers so far, which are then reset.  a worker process
+returns them with each result, and the parent merge()s them into its run.
+"""
+def take():
+    snapshot = (dict(counters), {name: list(t) for (name, t) in timers.items()})
+    counters.clear()
+    timers.clear()
+    return snapshot
+
+
+def merge(snapshot):
+    (worker_counters, worker_timers) = snapshot
+    for (name, n) in worker_counters.items():
+        counters[name] = counters.get(name, 0) + n
+    for (name, (seconds, calls)) in worker_timers.items():
+        t = timers.setdefault(name, [0.0, 0])
+        t[0] += seconds
+        t[1] += calls
+
+
+"""
+start of a run of program: a whole process, or one request of a server,
+whose arguments are then given as argv.
+"""
+def start(program, argv=None):
+    global run
+    profiler = None
+    if PROFILE_FILE:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    run = (program, sys.argv[1:] if argv is None else argv, time.perf_counter(), profiler)
+
+
+def finish():
+    global run
+    if run is None:
+        return
+    (program, argv, start_time, profiler) = run
+    run = None
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(f"{PROFILE_FILE}.{os.getpid()}")
+    if not ENABLED:
+        return
+    import json
+    summary = {
+        "program": program,
+        "pid": os.getpid(),
+        "argv": argv,
+        "seconds": time.perf_counter() - start_time,
+        "counters": counters,
+        "timers": {name: {"seconds": t[0], "calls": t[1]} for (name, t) in timers.items()},
+    }
+    fd = os.open(STATS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(summary) + "\n").encode())
+    finally:
+        os.close(fd)
+    counters.clear()
+    timers.clear()